@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""Memory, file descriptors, disk usage and throughput of the storage
+backends with many users.  Each backend runs in its own process: the users
+register and upload a few records, then concurrent clients sync random
+users.
+
+    $ python bench/backends.py [--users 10000] [--syncs 20000] [--threads 8]
+"""
+
+from __future__ import print_function, division
+
+import os
+import sys
+import json
+import time
+import base64
+import random
+import shutil
+import tempfile
+import resource
+import subprocess
+import threading
+
+from argparse import ArgumentParser, SUPPRESS
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from werkzeug.test import Client
+from werkzeug.wrappers import Response
+
+from weave import make_app
+from weave.minimal.bench import percentile, payload
+
+
+def headers(uid):
+    auth = base64.b64encode(('%s:password' % uid).encode('utf-8')).decode('ascii')
+    return {'Authorization': 'Basic ' + auth}
+
+
+def request(client, method, path, uid, data=None):
+    rv = client.open(path, method=method, headers=headers(uid),
+                     data=None if data is None else json.dumps(data))
+    rv.get_data()
+    if rv.status_code >= 400:
+        raise RuntimeError('%s %s returned %i' % (method, path, rv.status_code))
+    return rv
+
+
+def parallel(func, jobs, threads):
+    """Run `func(job)` for all jobs on `threads` threads, returns the sorted
+    latencies and the elapsed time."""
+
+    samples, lock = [], threading.Lock()
+
+    def worker(jobs):
+        for job in jobs:
+            start = time.time()
+            func(job)
+            with lock:
+                samples.append(time.time() - start)
+
+    pool = [threading.Thread(target=worker, args=(jobs[i::threads], ))
+            for i in range(threads)]
+    start = time.time()
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    return sorted(samples), time.time() - start
+
+
+def disk_usage(path):
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, dirs, files in os.walk(path) for name in files)
+
+
+def run(options):
+    data_dir = tempfile.mkdtemp(prefix='weave-bench-')
+    app = make_app(data_dir, register=True, backend=options.backend)
+    client = Client(app, Response)
+    users = ['user%05i' % i for i in range(options.users)]
+
+    def setup(uid):
+        request(client, 'PUT', '/user/1.0/%s' % uid, uid, {'password': 'password'})
+        request(client, 'PUT', '/1.1/%s/storage/meta/global' % uid, uid,
+                {'payload': payload(options.size)})
+        request(client, 'POST', '/1.1/%s/storage/history' % uid, uid,
+                [{'id': 'h%04i' % i, 'payload': payload(options.size)}
+                 for i in range(options.records)])
+
+    def sync(uid):
+        rv = request(client, 'GET', '/1.1/%s/info/collections' % uid, uid)
+        since = json.loads(rv.get_data(as_text=True))['history']
+        request(client, 'POST', '/1.1/%s/storage/history' % uid, uid,
+                [{'id': 'h%04i' % random.randint(0, 9999), 'payload': payload(options.size)}])
+        request(client, 'GET', '/1.1/%s/storage/history?full=1&newer=%s' % (uid, since), uid)
+
+    try:
+        samples, setup_elapsed = parallel(setup, users, options.threads)
+        samples, elapsed = parallel(sync, [random.choice(users) for i in range(options.syncs)],
+                                    options.threads)
+        report = {
+            'backend': options.backend,
+            'setup': len(users) / setup_elapsed,
+            'syncs': len(samples) / elapsed,
+            'p50': percentile(samples, 50) * 1000,
+            'p99': percentile(samples, 99) * 1000,
+            'rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+            'fds': len(os.listdir('/proc/self/fd')) if os.path.isdir('/proc/self/fd') else -1,
+            'disk': disk_usage(data_dir) / 1024.0 / 1024.0,
+        }
+    finally:
+        shutil.rmtree(data_dir)
+
+    print(json.dumps(report))
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--users", default=10000, type=int)
+    parser.add_argument("--records", default=20, type=int, help="history records per user")
+    parser.add_argument("--size", default=256, type=int, help="payload size")
+    parser.add_argument("--syncs", default=20000, type=int)
+    parser.add_argument("--threads", default=8, type=int)
+    parser.add_argument("--backends", default="files,shared")
+    parser.add_argument("--backend", default=None, help=SUPPRESS)
+    options = parser.parse_args()
+
+    if options.backend:
+        return run(options)
+
+    print('%-8s %10s %10s %9s %9s %9s %6s %9s' % (
+        'backend', 'users/s', 'syncs/s', 'p50', 'p99', 'max rss', 'fds', 'disk'))
+    for backend in options.backends.split(','):
+        rv = subprocess.check_output([sys.executable, __file__, '--backend', backend] +
+                                     sys.argv[1:], stderr=open(os.devnull, 'w'))
+        report = json.loads(rv.decode('utf-8').strip().splitlines()[-1])
+        print('%-8s %10.1f %10.1f %7.2fms %7.2fms %7.1fMB %6i %7.1fMB' % (
+            backend, report['setup'], report['syncs'], report['p50'], report['p99'],
+            report['rss'], report['fds'], report['disk']))
+
+
+if __name__ == '__main__':
+    main()
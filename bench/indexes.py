@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""Incremental sync latency against collection size, with and without the
+secondary indexes on collection tables.
+
+    $ python bench/indexes.py [--sizes 1000,10000,100000] [--repeat 50]
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import shutil
+import sqlite3
+import tempfile
+
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from weave.minimal import storage
+
+QUERIES = [
+    ('newer', 'SELECT id FROM history WHERE modified > ?'),
+    ('newer full', 'SELECT %s FROM history WHERE modified > ? ORDER BY modified DESC'
+                   % ','.join(storage.FIELDS)),
+    ('parentid', "SELECT id FROM history WHERE parentid = 'folder7'"),
+    ('index', 'SELECT id FROM history ORDER BY sortindex DESC LIMIT 50'),
+    ('has_modified', 'SELECT MAX(modified) FROM history'),
+]
+
+
+def populate(db, size):
+    now = time.time() - size
+    storage.migrate(db)
+    storage.create_collection(db, 'history')
+    db.executemany(storage.UPSERT % 'history', (
+        dict(zip(storage.COLUMNS, ['id%i' % i, round(now + i, 2), i % 100, 'x' * 256,
+                                   256, 'folder%i' % (i % 50), None, None, None]))
+        for i in range(size)))
+    db.commit()
+    return now + size - size // 100  # 1% of the rows are newer
+
+
+def measure(db, newer, repeat):
+    rv = {}
+    for name, sql in QUERIES:
+        args = [newer] if '?' in sql else []
+        start = time.time()
+        for i in range(repeat):
+            db.execute(sql, args).fetchall()
+        rv[name] = (time.time() - start) / repeat * 1000
+    return rv
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", default="1000,10000,100000")
+    parser.add_argument("--repeat", default=50, type=int)
+    options = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    try:
+        print('%-8s %-14s %10s %10s' % ('size', 'query', 'no index', 'indexed'))
+        for size in map(int, options.sizes.split(',')):
+            db = sqlite3.connect(os.path.join(tmp, 'bench.%i' % size))
+            newer = populate(db, size)
+
+            indexed = measure(db, newer, options.repeat)
+            for (name, ) in db.execute("SELECT name FROM sqlite_master WHERE "
+                                       "type='index' AND name LIKE 'idx_%'").fetchall():
+                db.execute('DROP INDEX %s' % name)
+            plain = measure(db, newer, options.repeat)
+
+            for name, sql in QUERIES:
+                print('%-8i %-14s %8.3fms %8.3fms' % (size, name, plain[name], indexed[name]))
+            db.close()
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""Encode and decode time of the installed JSON backends on batches of
+WBOs as they are uploaded (POST) and downloaded (GET full=1).
+
+    $ python bench/serializers.py [--batch 100,1000] [--size 256] [--repeat 20]
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import base64
+import binascii
+import random
+
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from weave.minimal import utils
+
+
+def batch(count, size):
+    """Bookmark-like WBOs with a base64 payload of about `size` bytes."""
+    now = time.time()
+    return [{'id': base64.urlsafe_b64encode(os.urandom(9)).decode('ascii'),
+             'modified': round(now - random.random() * 86400, 2),
+             'sortindex': random.randint(0, 1000),
+             'parentid': 'folder%i' % (i % 50),
+             'payload': '{"ciphertext": "%s", "IV": "%s", "hmac": "%s"}' % (
+                 base64.b64encode(os.urandom(size * 3 // 4)).decode('ascii'),
+                 base64.b64encode(os.urandom(16)).decode('ascii'),
+                 binascii.hexlify(os.urandom(32)).decode('ascii'))}
+            for i in range(count)]
+
+
+def measure(serializer, records, repeat):
+    data = serializer.dumps(records)
+
+    start = time.time()
+    for i in range(repeat):
+        serializer.dumps(records)
+    encode = (time.time() - start) / repeat * 1000
+
+    start = time.time()
+    for i in range(repeat):
+        serializer.loads(data)
+    decode = (time.time() - start) / repeat * 1000
+
+    return encode, decode, len(data)
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--batch", default="100,1000,10000")
+    parser.add_argument("--size", default=256, type=int)
+    parser.add_argument("--repeat", default=20, type=int)
+    options = parser.parse_args()
+
+    print('%-8s %-10s %10s %10s %10s' % ('batch', 'backend', 'dumps', 'loads', 'bytes'))
+    for count in map(int, options.batch.split(',')):
+        records = batch(count, options.size)
+        for serializer in utils.serializers():
+            encode, decode, length = measure(serializer, records, options.repeat)
+            print('%-8i %-10s %8.3fms %8.3fms %10i' % (
+                count, serializer.name, encode, decode, length))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""Throughput and latency of the serving modes under concurrent sync clients
+while a number of idle connections are held open: werkzeug's threaded
+server, gevent (if installed) and the ASGI adapter on uvicorn (if installed).
+
+    $ python bench/servers.py [--clients 16] [--requests 50] [--idle 500]
+"""
+
+from __future__ import print_function, division
+
+import os
+import sys
+import json
+import time
+import base64
+import shutil
+import socket
+import tempfile
+import threading
+
+from argparse import ArgumentParser
+
+try:
+    from http.client import HTTPConnection
+except ImportError:
+    from httplib import HTTPConnection
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from weave import make_app
+from weave.minimal.bench import percentile, payload
+
+
+def werkzeug(app, port):
+    from werkzeug.serving import make_server
+    server = make_server('127.0.0.1', port, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server.shutdown
+
+
+def gevent(app, port):
+    from gevent.pywsgi import WSGIServer
+    server = WSGIServer(('127.0.0.1', port), app, log=None)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return lambda: None  # the hub belongs to the thread, let it die with us
+
+
+def uvicorn(app, port):
+    import uvicorn
+    from weave.minimal.asgi import ASGI
+    server = uvicorn.Server(uvicorn.Config(ASGI(app), port=port, log_level='warning',
+                                           lifespan='off'))
+    thread = threading.Thread(target=server.run)
+    thread.daemon = True
+    thread.start()
+
+    def stop():
+        server.should_exit = True
+        thread.join()
+    return stop
+
+SERVERS = [('werkzeug', werkzeug), ('gevent', gevent), ('uvicorn', uvicorn)]
+
+
+class Client(object):
+
+    def __init__(self, port, uid):
+        self.con = HTTPConnection('127.0.0.1', port, timeout=60)
+        auth = base64.b64encode(('%s:password' % uid).encode('utf-8')).decode('ascii')
+        self.headers = {'Authorization': 'Basic ' + auth}
+        self.uid = uid
+
+    def request(self, method, path, data=None):
+        self.con.request(method, path, None if data is None else json.dumps(data),
+                         self.headers)
+        rv = self.con.getresponse()
+        body = rv.read()
+        if rv.status >= 400:
+            raise RuntimeError('%s %s returned %i' % (method, path, rv.status))
+        return body
+
+    def sync(self, size):
+        """One sync: poll, upload a few records, fetch what changed."""
+        rv = json.loads(self.request('GET', '/1.1/%s/info/collections' % self.uid))
+        self.request('POST', '/1.1/%s/storage/history' % self.uid,
+                     [{'id': 'h%08i' % (time.time() * 1000 % 10**8), 'payload': payload(size)}])
+        self.request('GET', '/1.1/%s/storage/history?full=1&newer=%s' % (
+            self.uid, rv.get('history', 0)))
+
+
+def run(name, start, options):
+    data_dir = tempfile.mkdtemp(prefix='weave-bench-')
+    app = make_app(data_dir, register=True)
+    stop = start(app, options.port)
+    time.sleep(0.5)
+
+    idle = []
+    try:
+        for i in range(options.clients):
+            client = Client(options.port, 'bench%i' % i)
+            client.request('PUT', '/user/1.0/bench%i' % i, {'password': 'password'})
+            client.request('POST', '/1.1/bench%i/storage/history' % i,
+                           [{'id': 'h%08i' % j, 'payload': payload(options.size)}
+                            for j in range(options.records)])
+
+        for i in range(options.idle):
+            idle.append(socket.create_connection(('127.0.0.1', options.port)))
+
+        samples, errors, lock = [], [], threading.Lock()
+
+        def worker(uid):
+            client = Client(options.port, uid)
+            try:
+                for i in range(options.requests):
+                    begin = time.time()
+                    client.sync(options.size)
+                    with lock:
+                        samples.append(time.time() - begin)
+            except Exception as ex:
+                errors.append(ex)
+
+        threads = [threading.Thread(target=worker, args=('bench%i' % i, ))
+                   for i in range(options.clients)]
+        begin = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - begin
+    finally:
+        for sock in idle:
+            sock.close()
+        stop()
+        shutil.rmtree(data_dir)
+
+    samples.sort()
+    print('%-10s %10.1f %8.2fms %8.2fms %8i' % (
+        name, len(samples) / elapsed, percentile(samples, 50) * 1000,
+        percentile(samples, 99) * 1000, len(errors)))
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--clients", default=16, type=int, help="concurrent clients")
+    parser.add_argument("--requests", default=50, type=int, help="syncs per client")
+    parser.add_argument("--records", default=500, type=int, help="initial records")
+    parser.add_argument("--size", default=256, type=int, help="payload size")
+    parser.add_argument("--idle", default=200, type=int, help="idle connections")
+    parser.add_argument("--port", default=8091, type=int)
+    parser.add_argument("--servers", default=','.join(name for name, _ in SERVERS))
+    options = parser.parse_args()
+
+    print('%-10s %10s %10s %10s %8s' % ('server', 'syncs/s', 'p50', 'p99', 'errors'))
+    for name, start in SERVERS:
+        if name not in options.servers.split(','):
+            continue
+        try:
+            __import__(name)
+        except ImportError:
+            print('%-10s not installed' % name)
+            continue
+        run(name, start, options)
+        options.port += 1
+
+
+if __name__ == '__main__':
+    main()
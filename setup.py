@@ -34,6 +34,7 @@ setup(
     install_requires=requires,
     entry_points={
         'console_scripts':
-            ['weave-minimal = weave:main'],
+            ['weave-minimal = weave:main',
+             'weave-minimal-bench = weave.minimal.bench:main'],
     },
 )
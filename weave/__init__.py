@@ -37,9 +37,10 @@ if sys.version_info < (2, 7):
 
 import os
 import errno
-import hashlib
 import sqlite3
+import hashlib
 import logging
+import functools
 
 from os.path import join, dirname
 from argparse import ArgumentParser, HelpFormatter, SUPPRESS
@@ -57,6 +58,16 @@ from werkzeug.exceptions import HTTPException, NotFound, NotImplemented
 from werkzeug.wsgi import SharedDataMiddleware
 
 from weave.minimal import user, storage, misc
+from weave.minimal.pool import Pool
+from weave.minimal.cache import LRUCache, RecordCache
+from weave.minimal.expiry import Sweeper
+from weave.minimal.metrics import Metrics
+from weave.minimal.admission import Admission
+from weave.minimal.compression import Compression
+from weave.minimal.writer import Writer
+from weave.minimal.quota import Quota
+from weave.minimal.layout import LAYOUTS, migrate
+from weave.minimal.backend import BACKENDS, migrate as migrate_backend
 from weave.minimal.utils import encode, Request
 
 logging.basicConfig(
@@ -157,7 +168,12 @@ class Weave(object):
 
     salt = r'\x14Q\xd4JbDk\x1bN\x84J\xd0\x05\x8a\x1b\x8b\xa6&V\x1b\xc5\x91\x97\xc4'
 
-    def __init__(self, data_dir, registration):
+    # seconds a successful login is cached, bounds the time another process
+    # (or an admin) may remove an account without this process noticing
+    auth_ttl = 300
+
+    def __init__(self, data_dir, registration, pool_size=64, profile='normal',
+                 layout='flat', backend='files'):
 
         try:
             os.makedirs(data_dir)
@@ -167,32 +183,82 @@ class Weave(object):
 
         self.data_dir = data_dir
         self.registration = registration
+        self.pool = Pool(pool_size, setup=functools.partial(
+            storage.setup, profile=profile, schema=BACKENDS[backend].schema))
+        self.backend = BACKENDS[backend](data_dir, self.pool, layout)
+        self.metadata = LRUCache(1024)
+        self.credentials = LRUCache(4096, ttl=self.auth_ttl)
+        self.records = RecordCache()
 
     def crypt(self, password):
         return hashlib.sha1((self.salt+password).encode('utf-8')).hexdigest()[:16]
 
+    def store(self, user, password):
+        """The :class:`weave.minimal.backend.Store` of a user."""
+        return self.backend.store(user, self.crypt(password))
+
     def dbpath(self, user, password):
-        return join(self.data_dir, (user + '.' + self.crypt(password)))
+        return self.store(user, password).dbpath
+
+    def exists(self, uid):
+        return self.backend.exists(uid)
+
+    def authenticate(self, uid, password):
+        """Returns the store for valid credentials or None."""
+
+        key = uid, self.crypt(password)
+        store = self.credentials.get(key)
+        if store is None:
+            store = self.backend.find(*key)
+            if store is None:
+                return None
+            self.credentials.set(key, store)
+        return store
 
     def initialize(self, uid, password):
 
-        dbpath = self.dbpath(uid, password)
+        store = self.backend.create(uid, self.crypt(password))
+        self.metadata.invalidate(store.key)
+        self.records.discard(store.key)
 
-        try:
-            os.unlink(dbpath)
-        except OSError:
-            pass
+        logger.info("database for `%s` created at `%s`", uid, store.dbpath)
+
+    def reset(self, uid, password):
+        """Delete all collections of `uid`, returns False for invalid
+        credentials."""
+
+        store = self.backend.reset(uid, self.crypt(password))
+        if store is None:
+            return False
+
+        self.metadata.invalidate(store.key)
+        self.records.discard(store.key)
+        return True
+
+    def remove(self, uid, password):
+
+        crypt = self.crypt(password)
+        self.backend.remove(uid, crypt)
+        key = self.backend.store(uid, crypt).key
+        self.metadata.invalidate(key)
+        self.records.discard(key)
+        self.credentials.invalidate((uid, crypt))
 
-        with sqlite3.connect(dbpath) as con:
-            con.commit()
+    def rename(self, uid, old, new):
+        """Change the password of `uid` from `old` to `new`, raises OSError."""
 
-        logger.info("database for `%s` created at `%s`", uid, dbpath)
+        crypt = self.crypt(old)
+        key = self.backend.store(uid, crypt).key
+        self.metadata.invalidate(key)
+        self.records.discard(key)
+        self.credentials.invalidate((uid, crypt))
+        self.backend.rename(uid, crypt, self.crypt(new))
 
     def dispatch(self, request, start_response):
         adapter = url_map.bind_to_environ(request.environ)
         try:
-            handler, values = adapter.match()
-            return handler(self, request.environ, request, **values)
+            request.url_rule, values = adapter.match(return_rule=True)
+            return request.url_rule.endpoint(self, request.environ, request, **values)
         except NotFound:
             return Response('Not Found', 404)
         except HTTPException as e:
@@ -201,18 +267,39 @@ class Weave(object):
     def wsgi_app(self, environ, start_response):
         request = Request(environ)
         response = self.dispatch(request, start_response)
-        if hasattr(response, 'headers'):
-            response.headers['X-Weave-Backoff'] = 0  # we have no load!1
+        if hasattr(response, 'headers') and 'X-Weave-Backoff' not in response.headers:
+            response.headers['X-Weave-Backoff'] = 0  # no admission control, no load!1
         return response(environ, start_response)
 
     def __call__(self, environ, start_response):
         return self.wsgi_app(environ, start_response)
 
 
-def make_app(data_dir='.data/', base_url=None, register=False):
-    application = Weave(data_dir, register)
+def make_app(data_dir='.data/', base_url=None, register=False, pool_size=64,
+             expire_interval=600, sqlite_profile='normal', metrics=False,
+             metrics_path=None, admission=None, compression=None, data_layout='flat',
+             coalesce=None, backend='files', item_cache=8, quota=None, shard=None):
+    application = Weave(data_dir, register, pool_size, sqlite_profile, data_layout,
+                        backend)
+    application.records.capacity = item_cache * 1024 * 1024
+    if quota is not None:
+        application.quota = Quota(**quota)
+    if coalesce is not None:
+        application.writer = Writer(application.pool, **coalesce)
+    if admission is not None:
+        application.admission = Admission(**admission)
+        application.dispatch = application.admission.wrap(application.dispatch)
+    if metrics or metrics_path:
+        application.metrics = Metrics(application, metrics_path)
+        application.dispatch = application.metrics.wrap(application.dispatch)
+    if expire_interval > 0:
+        application.sweeper = Sweeper(application, expire_interval, shard)
+        application.sweeper.start()
     application.wsgi_app = SharedDataMiddleware(application.wsgi_app, {
         "/static": join(dirname(__file__), "static")})
+    if compression is not None:
+        application.compression = Compression(**compression)
+        application.wsgi_app = application.compression.wrap(application.wsgi_app)
     application.wsgi_app = ReverseProxied(application.wsgi_app, base_url)
     return application
 
@@ -242,6 +329,54 @@ def main():
            help="public URL, e.g. https://example.org/weave/")
     option("--register", dest="creds", default=None, metavar="user:pass",
            help="register a new user and exit")
+    option("--data-layout", dest="data_layout", default="flat", choices=sorted(LAYOUTS),
+           help="flat (default) or sharded into hashed subdirectories")
+    option("--migrate-layout", dest="migrate_layout", action="store_true",
+           help="move all databases into --data-layout and exit, stop the "
+           "server first")
+    option("--storage-backend", dest="backend", default="files", choices=sorted(BACKENDS),
+           help="a database per user (files, default) or one for all (shared)")
+    option("--migrate-backend", dest="migrate_backend", action="store_true",
+           help="copy all accounts into --storage-backend and exit, stop the "
+           "server first")
+    option("--pool-size", dest="pool_size", default=64, type=int, metavar="64",
+           help="maximum number of idle database connections")
+    option("--expire-interval", dest="expire_interval", default=600, type=int,
+           metavar="600", help="delete expired items every N seconds, 0 disables")
+    option("--sqlite-profile", dest="sqlite_profile", default="normal",
+           choices=sorted(storage.PROFILES), help="durability/performance "
+           "trade-off of the databases: safe, normal (default) or fast")
+    option("--metrics-path", dest="metrics_path", default=None, metavar="/metrics",
+           help="serve Prometheus metrics on this path")
+    option("--metrics-port", dest="metrics_port", default=None, type=int,
+           metavar="9090", help="serve Prometheus metrics on a separate port")
+    option("--max-reads", dest="max_reads", default=0, type=int, metavar="N",
+           help="concurrent read requests, enables admission control")
+    option("--max-writes", dest="max_writes", default=0, type=int, metavar="N",
+           help="concurrent write requests, enables admission control")
+    option("--queue-timeout", dest="queue_timeout", default=1.0, type=float,
+           metavar="1.0", help="seconds a request waits before it gets a 503")
+    option("--max-backoff", dest="max_backoff", default=1800, type=int,
+           metavar="1800", help="X-Weave-Backoff sent when saturated")
+    option("--compression-level", dest="compression_level", default=6, type=int,
+           metavar="6", help="gzip/deflate/br level of responses, 0 disables")
+    option("--compression-threshold", dest="compression_threshold", default=1024,
+           type=int, metavar="1024", help="do not compress smaller responses")
+    option("--coalesce-window", dest="coalesce_window", default=0, type=float,
+           metavar="0.005", help="commit writes to the same database arriving "
+           "within N seconds together, 0 disables")
+    option("--coalesce-max", dest="coalesce_max", default=64, type=int,
+           metavar="64", help="maximum number of writes per commit")
+    option("--item-cache", dest="item_cache", default=8, type=int, metavar="8",
+           help="megabytes of items cached for GET requests, 0 disables")
+    option("--quota", dest="quota", default=0, type=int, metavar="KB",
+           help="storage limit per user in KB, 0 is unlimited")
+    option("--quota-file", dest="quota_file", default=None, metavar="FILE",
+           help="JSON object of per-user limits in KB, overrides --quota")
+    option("--workers", dest="workers", default=1, type=int, metavar="1",
+           help="fork N worker processes, each serving a fixed share of users")
+    option("--health-path", dest="health_path", default=None, metavar="/workers",
+           help="serve the state of the workers on this path")
 
     option("--use-reloader", action="store_true", dest="reloader",
            help=SUPPRESS, default=False)
@@ -265,7 +400,61 @@ def main():
         logger.propagate = False
         logging.getLogger('werkzeug').propagate = False
 
-    app = make_app(options.data_dir, options.base_url, options.registration)
+    admission = None
+    if options.max_reads or options.max_writes:
+        admission = {'max_reads': options.max_reads or 64,
+                     'max_writes': options.max_writes or 8,
+                     'timeout': options.queue_timeout,
+                     'max_backoff': options.max_backoff}
+
+    if options.migrate_layout:
+        source = 'sharded' if options.data_layout == 'flat' else 'flat'
+        migrate(options.data_dir, source, options.data_layout)
+        sys.exit(os.EX_OK)
+
+    if options.migrate_backend:
+        source = 'shared' if options.backend == 'files' else 'files'
+        migrate_backend(options.data_dir, source, options.backend, options.data_layout)
+        sys.exit(os.EX_OK)
+
+    compression = None
+    if options.compression_level > 0:
+        compression = {'level': options.compression_level,
+                       'threshold': options.compression_threshold}
+
+    coalesce = None
+    if options.coalesce_window > 0:
+        coalesce = {'window': options.coalesce_window, 'max_batch': options.coalesce_max}
+
+    quota = None
+    if options.quota or options.quota_file:
+        quota = {'default': options.quota or None, 'path': options.quota_file}
+
+    def factory(shard=None):
+        # each worker expires the items of its own users
+        return make_app(options.data_dir, options.base_url, options.registration,
+                        options.pool_size,
+                        options.expire_interval if not options.creds else 0,
+                        options.sqlite_profile,
+                        options.metrics_port is not None, options.metrics_path,
+                        admission, compression, options.data_layout, coalesce,
+                        options.backend, options.item_cache, quota, shard)
+
+    if options.workers > 1 and not options.creds:
+        from weave.minimal.prefork import Master
+
+        def worker(index):
+            app = factory((index, options.workers))
+            if options.metrics_port is not None:
+                app.metrics.serve(options.host, options.metrics_port + index)
+            return app
+
+        prefix = urlsplit(options.base_url).path if options.base_url else None
+        Master(worker, options.workers, prefix, options.health_path).serve(
+            options.host, options.port)
+        sys.exit(os.EX_OK)
+
+    app = factory()
 
     if options.creds:
 
@@ -279,9 +468,16 @@ def main():
             logger.error("password too short, minimum length is 8")
             sys.exit(os.EX_DATAERR)
 
-        app.initialize(encode(username), passwd)
+        try:
+            app.initialize(encode(username), passwd)
+        except sqlite3.IntegrityError:
+            logger.error("user `%s` already exists", username)
+            sys.exit(os.EX_DATAERR)
         sys.exit(os.EX_OK)
 
+    if options.metrics_port is not None:
+        app.metrics.serve(options.host, options.metrics_port)
+
     try:
         from gevent.pywsgi import WSGIServer
         WSGIServer((options.host, options.port), app).serve_forever()
@@ -289,8 +485,33 @@ def main():
         run_simple(options.host, options.port, app, use_reloader=options.reloader, threaded=True)
 
 
+def from_environ(environ=os.environ):
+    """The application configured by environment variables, used by uWSGI,
+    Gunicorn and ASGI servers."""
+
+    return make_app(
+        data_dir=environ.get("DATA_DIR", ".data/"),
+        base_url=environ.get("BASE_URL", None),
+        register=bool(environ.get("ENABLE_REGISTRATION", "0")),
+        pool_size=int(environ.get("POOL_SIZE", 64)),
+        expire_interval=int(environ.get("EXPIRE_INTERVAL", 600)),
+        sqlite_profile=environ.get("SQLITE_PROFILE", "normal"),
+        metrics_path=environ.get("METRICS_PATH", None),
+        admission={"max_reads": int(environ.get("MAX_READS", 64)),
+                   "max_writes": int(environ.get("MAX_WRITES", 8))}
+                  if "MAX_READS" in environ or "MAX_WRITES" in environ else None,
+        compression={"level": int(environ.get("COMPRESSION_LEVEL", 6))}
+                    if environ.get("COMPRESSION_LEVEL", "6") != "0" else None,
+        data_layout=environ.get("DATA_LAYOUT", "flat"),
+        coalesce={"window": float(environ["COALESCE_WINDOW"]),
+                  "max_batch": int(environ.get("COALESCE_MAX", 64))}
+                 if float(environ.get("COALESCE_WINDOW", 0)) > 0 else None,
+        backend=environ.get("STORAGE_BACKEND", "files"),
+        item_cache=int(environ.get("ITEM_CACHE", 8)),
+        quota={"default": int(environ.get("QUOTA", 0)) or None,
+               "path": environ.get("QUOTA_FILE", None)}
+              if "QUOTA" in environ or "QUOTA_FILE" in environ else None)
+
+
 if sys.argv[0].endswith(("gunicorn", "uwsgi")):
-    application = make_app(
-        data_dir=os.environ.get("DATA_DIR", ".data/"),
-        base_url=os.environ.get("BASE_URL", None),
-        register=bool(os.environ.get("ENABLE_REGISTRATION", "0")))
+    application = from_environ()
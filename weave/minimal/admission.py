@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+import time
+import threading
+
+from werkzeug.wrappers import Response
+
+
+class Budget(object):
+    """Limits the number of concurrent requests of one kind.  Requests wait
+    up to `timeout` seconds for a free slot.
+
+    :param limit: maximum number of requests in flight
+    :param timeout: maximum time spent waiting in the queue
+    """
+
+    # weight of a new latency sample in the moving average
+    alpha = 0.2
+
+    def __init__(self, limit, timeout):
+        self.limit = limit
+        self.timeout = timeout
+        self.cond = threading.Condition()
+
+        self.inflight = 0
+        self.waiting = 0
+        self.latency = 0.0  # exponentially weighted moving average
+        self.wait = 0.0     # likewise, time spent in the queue
+        self.rejected = 0
+
+    def acquire(self):
+        """Returns True if the request may proceed."""
+
+        start = time.time()
+        deadline = start + self.timeout
+
+        with self.cond:
+            self.waiting += 1
+            try:
+                while self.inflight >= self.limit:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.rejected += 1
+                        return False
+                    self.cond.wait(remaining)
+                self.inflight += 1
+            finally:
+                self.waiting -= 1
+                self.wait += self.alpha * ((time.time() - start) - self.wait)
+        return True
+
+    def release(self, elapsed):
+        with self.cond:
+            self.inflight -= 1
+            self.latency += self.alpha * (elapsed - self.latency)
+            self.cond.notify()
+
+    def pressure(self, target, own=0):
+        """0.0 when idle, 1.0 or more when the budget is saturated, either by
+        requests in flight and waiting, time spent waiting or latency.  `own`
+        requests in flight are not counted."""
+        return max((self.inflight - own + self.waiting) / float(self.limit),
+                   self.wait / self.timeout if self.timeout else 0.0,
+                   self.latency / target)
+
+
+class Admission(object):
+    """Admission control around :meth:`weave.Weave.dispatch` with separate
+    budgets for reads and writes (POST, PUT and DELETE).
+
+    Every response carries a computed X-Weave-Backoff, which grows from zero
+    at 75% pressure to `max_backoff` seconds on saturation.  A request that
+    does not get a slot within `timeout` seconds is answered with 503 and a
+    Retry-After header.
+
+    :param max_reads: concurrent read requests
+    :param max_writes: concurrent write requests
+    :param timeout: seconds a request may wait for a slot
+    :param max_backoff: seconds clients are asked to back off on saturation
+    """
+
+    # latency (seconds) considered to be saturation
+    target = 2.0
+
+    def __init__(self, max_reads=64, max_writes=8, timeout=1.0, max_backoff=1800):
+        self.reads = Budget(max_reads, timeout)
+        self.writes = Budget(max_writes, timeout)
+        self.max_backoff = max_backoff
+
+    def backoff(self, budget, own=0):
+        pressure = budget.pressure(self.target, own)
+        if pressure < 0.75:
+            return 0
+        return int(min(1.0, (pressure - 0.75) * 4) * self.max_backoff)
+
+    def wrap(self, dispatch):
+
+        def wrapper(request, start_response):
+
+            budget = self.writes if request.method in ('POST', 'PUT', 'DELETE') else self.reads
+            if not budget.acquire():
+                backoff = str(max(1, self.backoff(budget)))
+                return Response('Service Unavailable', 503, headers={
+                    'Retry-After': backoff, 'X-Weave-Backoff': backoff})
+
+            start = time.time()
+            try:
+                response = dispatch(request, start_response)
+            except Exception:
+                budget.release(time.time() - start)
+                raise
+
+            if hasattr(response, 'headers'):
+                response.headers['X-Weave-Backoff'] = str(self.backoff(budget, own=1))
+
+            if not isinstance(response, Response) or not response.is_streamed:
+                budget.release(time.time() - start)
+                return response
+
+            def iterate(body):
+                try:
+                    for chunk in body:
+                        yield chunk
+                finally:
+                    if hasattr(body, 'close'):
+                        body.close()
+                    budget.release(time.time() - start)
+
+            response.response = iterate(response.response)
+            return response
+
+        return wrapper
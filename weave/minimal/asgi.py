@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""ASGI entry point, Python 3 only.  Serves the WSGI application from an
+asyncio event loop, e.g. using uvicorn:
+
+    $ env DATA_DIR=/var/lib/... uvicorn --factory weave.minimal.asgi:create
+
+Idle and slow connections only cost the event loop, the application itself
+(and therefore every SQLite call) runs on a bounded thread pool.
+"""
+
+import io
+import os
+import sys
+import asyncio
+
+from concurrent.futures import ThreadPoolExecutor
+
+from weave.minimal.utils import Request, partition
+
+
+def make_environ(scope, body):
+    """The WSGI environment of an ASGI HTTP request."""
+
+    server = scope.get('server') or ('localhost', 80)
+    rv = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+
+    for name, value in scope['headers']:
+        name, value = name.decode('latin-1').upper().replace('-', '_'), value.decode('latin-1')
+        if name == 'TRANSFER_ENCODING':
+            continue  # decoded by the server
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        rv[name] = rv[name] + ',' + value if name in rv else value
+
+    # the body is buffered, chunked requests do not send a length
+    rv['CONTENT_LENGTH'] = str(len(body))
+    return rv
+
+
+class ASGI(object):
+    """Adapts the WSGI application returned by :func:`weave.make_app` to ASGI.
+
+    Requests are run on a pool of `workers` threads.  At most `per_user`
+    requests of the same user run (or stream their response) at a time, so a
+    single client syncing a large collection can not occupy the whole pool.
+
+    :param app: the WSGI application
+    :param workers: size of the thread pool
+    :param per_user: concurrent requests per user
+    """
+
+    def __init__(self, app, workers=16, per_user=2):
+        self.app = app
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='weave-asgi')
+        self.per_user = per_user
+        self.users = {}  # uid -> [semaphore, requests], only touched by the loop
+
+    def acquire(self, uid):
+        if uid not in self.users:
+            self.users[uid] = [asyncio.Semaphore(self.per_user), 0]
+        self.users[uid][1] += 1
+        return self.users[uid][0]
+
+    def release(self, uid):
+        self.users[uid][1] -= 1
+        if self.users[uid][1] == 0:
+            del self.users[uid]
+
+    async def __call__(self, scope, receive, send):
+
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    self.executor.shutdown(wait=False)
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+
+        if scope['type'] != 'http':
+            return
+
+        body = []
+        size = 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body.append(message.get('body', b''))
+            size += len(body[-1])
+            if size > Request.max_content_length:
+                await send({'type': 'http.response.start', 'status': 413,
+                            'headers': [(b'content-type', b'text/plain')]})
+                await send({'type': 'http.response.body', 'body': b'Request Entity Too Large'})
+                return
+            if not message.get('more_body', False):
+                break
+
+        uid = partition(scope['path'])
+        semaphore = self.acquire(uid)
+        try:
+            async with semaphore:
+                await self.handle(make_environ(scope, b''.join(body)), send)
+        finally:
+            self.release(uid)
+
+    async def handle(self, env, send):
+
+        loop = asyncio.get_event_loop()
+        response = []
+
+        def start_response(status, headers, exc_info=None):
+            response[:] = status, headers
+            return lambda data: None  # write() is not supported
+
+        def call():
+            body = self.app(env, start_response)
+            return body, iter(body)
+
+        body, chunks = await loop.run_in_executor(self.executor, call)
+        try:
+            chunk = await loop.run_in_executor(self.executor, next, chunks, None)
+
+            status, headers = response
+            await send({'type': 'http.response.start', 'status': int(status[:3]),
+                        'headers': [(k.lower().encode('latin-1'), v.encode('latin-1'))
+                                    for k, v in headers]})
+
+            while chunk is not None:
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk,
+                                'more_body': True})
+                chunk = await loop.run_in_executor(self.executor, next, chunks, None)
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(body, 'close'):
+                await loop.run_in_executor(self.executor, body.close)
+
+
+def create(environ=os.environ):
+    """The ASGI application configured by environment variables, as the WSGI
+    application of :func:`weave.from_environ` plus ASGI_WORKERS and
+    ASGI_PER_USER."""
+
+    from weave import from_environ
+    return ASGI(from_environ(environ),
+                workers=int(environ.get("ASGI_WORKERS", 16)),
+                per_user=int(environ.get("ASGI_PER_USER", 2)))
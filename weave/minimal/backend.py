@@ -0,0 +1,466 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""Storage backends.  A backend manages the accounts and hands out a
+:class:`Store` for each user, which knows the SQL to read and write the
+user's collections:
+
+- :class:`Files` keeps one SQLite database per user and a table per
+  collection (the default),
+- :class:`Shared` keeps all users and collections in a single database.
+"""
+
+import os
+import json
+import errno
+import logging
+import sqlite3
+
+from os.path import join, dirname, isfile
+
+from weave.minimal import storage
+from weave.minimal.pool import Pool
+from weave.minimal.layout import LAYOUTS
+from weave.minimal.utils import chunked
+
+logger = logging.getLogger("weave-minimal")
+
+# ids per DELETE statement, see Store.delete
+DELETE_CHUNK = 500
+
+
+class Store(object):
+    """The collections of a user in its own database, one table each.
+
+    :param dbpath: the database
+    """
+
+    # columns restricting a table to the collection, see `bind`
+    scope = ()
+
+    def __init__(self, dbpath):
+        self.dbpath = dbpath
+        self.key = dbpath  # of the cached metadata
+
+    def table(self, cid):
+        return cid
+
+    def values(self, cid):
+        return ()
+
+    def compile(self, query, kind, cid, fields=('id', )):
+        """The SQL of :meth:`weave.minimal.query.Query.compile` for `cid`."""
+        return query.compile(kind, self.table(cid), fields, self.scope)
+
+    def bind(self, query, cid, now):
+        return query.bind(now, self.values(cid))
+
+    def metadata(self, db):
+        res = db.execute('SELECT name, modified, count, usage FROM _collections')
+        return dict((row[0], row[1:]) for row in res)
+
+    def usage(self, db):
+        """The payload size of all collections in bytes, maintained by the
+        triggers."""
+        return db.execute('SELECT COALESCE(SUM(usage), 0) FROM _collections').fetchone()[0]
+
+    def expires(self, db, cid, now):
+        """The earliest expiry after `now` of an item of `cid` or None."""
+        try:
+            return db.execute('SELECT MIN(expiry) FROM %s WHERE expiry > ?' % cid,
+                              [now]).fetchone()[0]
+        except sqlite3.OperationalError:
+            return None
+
+    def sizes(self, db, cid, ids):
+        """The payload size of the existing items `ids` in bytes."""
+        try:
+            return db.execute('SELECT COALESCE(SUM(payload_size), 0) FROM %s WHERE id IN '
+                              '(SELECT value FROM json_each(?))' % cid,
+                              [json.dumps(ids)]).fetchone()[0]
+        except sqlite3.OperationalError:
+            return 0  # no such collection
+
+    def modified(self, db, cid):
+        rv = db.execute('SELECT modified FROM _collections WHERE name=?', [cid]).fetchone()
+        return rv[0] if rv is not None else None
+
+    def upsert(self, db, cid, rows):
+        storage.create_collection(db, cid)
+        db.executemany(storage.UPSERT % cid, rows)
+
+    def get(self, db, cid, id):
+        """The (modified, expiry, wbo) of an item or None, regardless of its
+        expiry."""
+        return db.execute('SELECT modified, expiry, wbo FROM %s WHERE id=?' % cid,
+                          [id]).fetchone()
+
+    def delete(self, db, cid, ids):
+        """Delete the items `ids` (any iterable), returns the number of
+        deleted items.  The ids are bound as JSON arrays of at most
+        :data:`DELETE_CHUNK` items, so the statement is the same regardless
+        of their number.  The triggers update the metadata."""
+        sql = 'DELETE FROM %s WHERE id IN (SELECT value FROM json_each(?))' % cid
+        return sum(db.execute(sql, [json.dumps(chunk)]).rowcount
+                   for chunk in chunked(ids, DELETE_CHUNK))
+
+
+class SharedStore(Store):
+    """The collections of a user in the `items` table of :class:`Shared`."""
+
+    scope = ('user', 'collection')
+
+    def __init__(self, dbpath, uid):
+        self.dbpath = dbpath
+        self.uid = uid
+        self.key = dbpath, uid
+
+    def table(self, cid):
+        return 'items'
+
+    def values(self, cid):
+        return self.uid, cid
+
+    def metadata(self, db):
+        res = db.execute('SELECT name, modified, count, usage FROM collections '
+                         'WHERE user=?', [self.uid])
+        return dict((row[0], row[1:]) for row in res)
+
+    def usage(self, db):
+        return db.execute('SELECT COALESCE(SUM(usage), 0) FROM collections WHERE user=?',
+                          [self.uid]).fetchone()[0]
+
+    def expires(self, db, cid, now):
+        return db.execute('SELECT MIN(expiry) FROM items WHERE user=? AND collection=? '
+                          'AND expiry > ?', [self.uid, cid, now]).fetchone()[0]
+
+    def sizes(self, db, cid, ids):
+        return db.execute('SELECT COALESCE(SUM(payload_size), 0) FROM items WHERE user=? '
+                          'AND collection=? AND id IN (SELECT value FROM json_each(?))',
+                          [self.uid, cid, json.dumps(ids)]).fetchone()[0]
+
+    def modified(self, db, cid):
+        rv = db.execute('SELECT modified FROM collections WHERE user=? AND name=?',
+                        [self.uid, cid]).fetchone()
+        return rv[0] if rv is not None else None
+
+    def upsert(self, db, cid, rows):
+        db.executemany(Shared.UPSERT, [dict(row, user=self.uid, collection=cid)
+                                       for row in rows])
+
+    def get(self, db, cid, id):
+        return db.execute('SELECT modified, expiry, wbo FROM items WHERE user=? AND '
+                          'collection=? AND id=?', [self.uid, cid, id]).fetchone()
+
+    def delete(self, db, cid, ids):
+        sql = ('DELETE FROM items WHERE user=? AND collection=? AND '
+               'id IN (SELECT value FROM json_each(?))')
+        return sum(db.execute(sql, [self.uid, cid, json.dumps(chunk)]).rowcount
+                   for chunk in chunked(ids, DELETE_CHUNK))
+
+
+class Files(object):
+    """One database per user, named by the uid and the hash of its password
+    and placed by the data `layout`.  A login is valid if the database exists.
+
+    :param data_dir: the data directory
+    :param pool: the connection pool, set up with :attr:`schema`
+    :param layout: flat or sharded, see :mod:`weave.minimal.layout`
+    """
+
+    schema = staticmethod(storage.migrate)
+
+    def __init__(self, data_dir, pool, layout='flat'):
+        self.pool = pool
+        self.layout = LAYOUTS[layout](data_dir)
+
+    def store(self, uid, crypt):
+        return Store(self.layout.path(uid, crypt))
+
+    def find(self, uid, crypt):
+        """The store for valid credentials or None."""
+        dbpath = self.layout.find(uid, crypt)
+        return Store(dbpath) if dbpath is not None else None
+
+    def exists(self, uid):
+        return self.layout.exists(uid)
+
+    def accounts(self):
+        """Yields the (uid, crypt) of every account."""
+        for dbpath in self.layout.iterdbs():
+            yield self.layout.split(dbpath)
+
+    def unlink(self, dbpath):
+        for path in (dbpath, dbpath + '-wal', dbpath + '-shm'):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def create(self, uid, crypt, replace=False):
+        """Create an empty store (replacing an existing one) and return it."""
+
+        dbpath = self.layout.path(uid, crypt)
+        self.pool.discard(dbpath)
+        self.unlink(dbpath)
+
+        try:
+            os.makedirs(dirname(dbpath))
+        except OSError as ex:
+            if ex.errno != errno.EEXIST:
+                raise
+
+        con = sqlite3.connect(dbpath)
+        con.execute('PRAGMA journal_mode = WAL')
+        con.close()
+
+        self.layout.created(uid, dbpath)
+        return Store(dbpath)
+
+    def reset(self, uid, crypt):
+        """Delete all collections of an existing account, returns its store or
+        None for invalid credentials."""
+
+        if self.find(uid, crypt) is None:
+            return None
+        return self.create(uid, crypt)
+
+    def remove(self, uid, crypt):
+        dbpath = self.layout.path(uid, crypt)
+        self.pool.discard(dbpath)
+        self.unlink(dbpath)
+        self.layout.removed(uid, dbpath)
+
+    def rename(self, uid, old, new):
+        """Change the password hash of `uid` from `old` to `new`, raises
+        OSError."""
+
+        old_dbpath, new_dbpath = self.layout.path(uid, old), self.layout.path(uid, new)
+        self.pool.discard(old_dbpath)
+
+        os.rename(old_dbpath, new_dbpath)
+        for suffix in ('-wal', '-shm'):
+            if isfile(old_dbpath + suffix):
+                os.rename(old_dbpath + suffix, new_dbpath + suffix)
+
+        self.layout.removed(uid, old_dbpath)
+        self.layout.created(uid, new_dbpath)
+
+    def expire(self, now, users=None):
+        """Delete expired items, yields the store key and number of deleted
+        items of each database (of the uids accepted by `users`, a
+        predicate).  Connections are opened outside of the pool to not evict
+        the connections of active users."""
+
+        for dbpath in self.layout.iterdbs():
+            if users is not None and not users(self.layout.split(dbpath)[0]):
+                continue
+            if not isfile(dbpath):  # removed meanwhile
+                continue
+
+            db = self.pool.open(dbpath)
+            try:
+                with db:
+                    n = sum(storage.expire(db, cid, now)
+                            for cid in storage.iter_collections(db))
+            finally:
+                db.close()
+
+            yield dbpath, n
+
+
+class Shared(object):
+    """All users in a single database `weave.db` in the data directory.  Items
+    of all collections are kept in one table keyed by (user, collection, id),
+    so there is one file, one page cache and one schema no matter the number
+    of users.  The password hashes are kept in the `users` table.
+
+    :param data_dir: the data directory
+    :param pool: the connection pool, set up with :attr:`schema`
+    """
+
+    # bump when changing `schema`
+    version = 3
+
+    INDEXES = [('modified', 'modified, id'), ('sortindex', 'sortindex, id'),
+               ('parentid', 'parentid'), ('predecessorid', 'predecessorid')]
+
+    UPSERT = storage.upsert('items', SharedStore.scope)
+
+    def __init__(self, data_dir, pool, layout=None):
+        self.pool = pool
+        self.dbpath = join(data_dir, 'weave.db')
+
+    @staticmethod
+    def schema(db):
+        if db.execute('PRAGMA user_version').fetchone()[0] >= Shared.version:
+            return
+
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            db.execute('CREATE TABLE IF NOT EXISTS users (uid VARCHAR(64) PRIMARY KEY, '
+                       'crypt VARCHAR(16) NOT NULL)')
+            db.execute('CREATE TABLE IF NOT EXISTS collections (user VARCHAR(64), '
+                       'name VARCHAR(64), modified FLOAT, count INTEGER NOT NULL DEFAULT 0, '
+                       'usage INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (user, name))')
+            db.execute('CREATE TABLE IF NOT EXISTS items (user VARCHAR(64), '
+                       'collection VARCHAR(64), id VARCHAR(64), modified FLOAT, '
+                       'sortindex INTEGER, payload VARCHAR(256), payload_size INTEGER, '
+                       'parentid VARCHAR(64), predecessorid VARCHAR(64), ttl INTEGER, '
+                       'expiry FLOAT, wbo BLOB, PRIMARY KEY (user, collection, id))')
+
+            for field, columns in Shared.INDEXES:
+                db.execute('CREATE INDEX IF NOT EXISTS idx_items_%s ON items '
+                           '(user, collection, %s)' % (field, columns))
+            db.execute('CREATE INDEX IF NOT EXISTS idx_items_expiry ON items (expiry) '
+                       'WHERE expiry IS NOT NULL')
+            db.execute('CREATE INDEX IF NOT EXISTS idx_items_ttl ON items '
+                       '(user, collection, expiry) WHERE expiry IS NOT NULL')
+
+            # like `storage.create_triggers`, the metadata row is created with
+            # the first item of a collection
+            db.execute(
+                "CREATE TRIGGER IF NOT EXISTS trg_items_insert AFTER INSERT ON items BEGIN "
+                "INSERT OR IGNORE INTO collections (user, name) VALUES (NEW.user, NEW.collection); "
+                "UPDATE collections SET count = count + 1, "
+                "usage = usage + COALESCE(NEW.payload_size, 0), "
+                "modified = MAX(COALESCE(modified, 0), NEW.modified) "
+                "WHERE user = NEW.user AND name = NEW.collection; END")
+            db.execute(
+                "CREATE TRIGGER IF NOT EXISTS trg_items_update AFTER UPDATE ON items BEGIN "
+                "UPDATE collections SET usage = usage - COALESCE(OLD.payload_size, 0) "
+                "+ COALESCE(NEW.payload_size, 0), "
+                "modified = MAX(COALESCE(modified, 0), NEW.modified) "
+                "WHERE user = NEW.user AND name = NEW.collection; END")
+            db.execute('DROP TRIGGER IF EXISTS trg_items_delete')  # version 2
+            db.execute(
+                "CREATE TRIGGER trg_items_delete AFTER DELETE ON items BEGIN "
+                "UPDATE collections SET count = count - 1, "
+                "usage = usage - COALESCE(OLD.payload_size, 0), "
+                "modified = %s "
+                "WHERE user = OLD.user AND name = OLD.collection; END" % storage.DELETED)
+
+            db.execute('PRAGMA user_version = %i' % Shared.version)
+
+    def store(self, uid, crypt):
+        return SharedStore(self.dbpath, uid)
+
+    def find(self, uid, crypt):
+        with self.pool.connect(self.dbpath) as db:
+            rv = db.execute('SELECT 1 FROM users WHERE uid=? AND crypt=?',
+                            [uid, crypt]).fetchone()
+        return SharedStore(self.dbpath, uid) if rv is not None else None
+
+    def exists(self, uid):
+        with self.pool.connect(self.dbpath) as db:
+            return db.execute('SELECT 1 FROM users WHERE uid=?', [uid]).fetchone() is not None
+
+    def accounts(self):
+        with self.pool.connect(self.dbpath) as db:
+            rv = db.execute('SELECT uid, crypt FROM users').fetchall()
+        return iter(rv)
+
+    def clear(self, db, uid):
+        db.execute('DELETE FROM items WHERE user=?', [uid])
+        db.execute('DELETE FROM collections WHERE user=?', [uid])
+
+    def create(self, uid, crypt, replace=False):
+        """Create a new account, raises sqlite3.IntegrityError if `uid` is
+        taken unless `replace` is set."""
+        with self.pool.connect(self.dbpath) as db:
+            db.execute('INSERT %sINTO users (uid, crypt) VALUES (?, ?)'
+                       % ('OR REPLACE ' if replace else ''), [uid, crypt])
+            self.clear(db, uid)
+        return SharedStore(self.dbpath, uid)
+
+    def reset(self, uid, crypt):
+        with self.pool.connect(self.dbpath) as db:
+            if db.execute('SELECT 1 FROM users WHERE uid=? AND crypt=?',
+                          [uid, crypt]).fetchone() is None:
+                return None
+            self.clear(db, uid)
+        return SharedStore(self.dbpath, uid)
+
+    def remove(self, uid, crypt):
+        with self.pool.connect(self.dbpath) as db:
+            if db.execute('DELETE FROM users WHERE uid=? AND crypt=?',
+                          [uid, crypt]).rowcount:
+                self.clear(db, uid)
+
+    def rename(self, uid, old, new):
+        with self.pool.connect(self.dbpath) as db:
+            if not db.execute('UPDATE users SET crypt=? WHERE uid=? AND crypt=?',
+                              [new, uid, old]).rowcount:
+                raise OSError(errno.ENOENT, 'no such account', uid)
+
+    def expire(self, now, users=None):
+        with self.pool.connect(self.dbpath) as db:
+            rv = db.execute('SELECT user, COUNT(*) FROM items WHERE expiry < ? '
+                            'GROUP BY user', [now]).fetchall()
+            if users is None:
+                db.execute('DELETE FROM items WHERE expiry < ?', [now])
+            else:
+                rv = [(uid, n) for uid, n in rv if users(uid)]
+                db.executemany('DELETE FROM items WHERE user=? AND expiry < ?',
+                               [(uid, now) for uid, n in rv])
+
+        for uid, n in rv:
+            yield (self.dbpath, uid), n
+
+
+BACKENDS = {'files': Files, 'shared': Shared}
+
+
+def migrate(data_dir, source, target, layout='flat'):
+    """Copy all accounts and their collections from the `source` to the
+    `target` backend, returns the number of copied accounts.  The source is
+    left as is, the server must not run meanwhile."""
+
+    def pool(backend):
+        return Pool(1, setup=lambda db: storage.setup(db, schema=backend.schema))
+
+    src = BACKENDS[source](data_dir, pool(BACKENDS[source]), layout)
+    dst = BACKENDS[target](data_dir, pool(BACKENDS[target]), layout)
+
+    columns = ', '.join(storage.COLUMNS + ['wbo'])
+
+    n = 0
+    for uid, crypt in list(src.accounts()):
+        source_store, target_store = src.store(uid, crypt), dst.create(uid, crypt, replace=True)
+
+        # bring the source up to date, ATTACH does not migrate
+        with src.pool.connect(source_store.dbpath):
+            pass
+
+        db = dst.pool.acquire(target_store.dbpath)
+        try:
+            db.execute('ATTACH DATABASE ? AS src', [source_store.dbpath])
+            try:
+                with db:
+                    if isinstance(dst, Shared):
+                        for (cid, ) in db.execute('SELECT name FROM src._collections').fetchall():
+                            db.execute('INSERT INTO items (user, collection, %s) '
+                                       'SELECT ?, ?, %s FROM src.%s' % (columns, columns, cid),
+                                       [uid, cid])
+                        db.execute('INSERT OR REPLACE INTO collections '
+                                   '(user, name, modified, count, usage) '
+                                   'SELECT ?, name, modified, count, usage '
+                                   'FROM src._collections', [uid])
+                    else:
+                        for (cid, ) in db.execute('SELECT name FROM src.collections '
+                                                  'WHERE user=?', [uid]).fetchall():
+                            storage.create_collection(db, cid)
+                            db.execute('INSERT INTO main.%s (%s) SELECT %s FROM src.items '
+                                       'WHERE user=? AND collection=?' % (cid, columns, columns),
+                                       [uid, cid])
+                        db.execute('INSERT OR REPLACE INTO _collections '
+                                   '(name, modified, count, usage) '
+                                   'SELECT name, modified, count, usage '
+                                   'FROM src.collections WHERE user=?', [uid])
+            finally:
+                db.execute('DETACH DATABASE src')
+        finally:
+            dst.pool.release(db)
+        n += 1
+
+    logger.info("copied %i accounts to the %s backend", n, target)
+    return n
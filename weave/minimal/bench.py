@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""Load generator emulating Firefox sync sessions against an in-process
+weave-minimal using a temporary data directory.  Each simulated client
+
+1. registers an account,
+2. uploads bookmarks and history in batches (the initial sync),
+3. polls info/collections and fetches meta/global, and
+4. fetches new records incrementally using `newer`.
+
+Throughput and latency percentiles per endpoint are written as JSON, so the
+output of two runs can be compared:
+
+    $ weave-minimal-bench --users 10 --records 2000 > before.json
+"""
+
+from __future__ import print_function, division
+
+import os
+import sys
+import json
+import time
+import random
+import base64
+import shutil
+import hashlib
+import tempfile
+import threading
+
+from argparse import ArgumentParser
+
+from werkzeug.test import Client
+from werkzeug.wrappers import Response
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of an already sorted list."""
+    if not values:
+        return 0.0
+    return values[max(0, min(len(values) - 1, int(round(p / 100.0 * len(values))) - 1))]
+
+
+def summarize(samples, elapsed):
+    """Turns a list of latencies (in seconds) into a JSON-serializable dict."""
+
+    samples = sorted(samples)
+    return {
+        'requests': len(samples),
+        'throughput': round(len(samples) / elapsed, 2) if elapsed else 0.0,
+        'mean': round(sum(samples) / len(samples) * 1000, 3) if samples else 0.0,
+        'p50': round(percentile(samples, 50) * 1000, 3),
+        'p95': round(percentile(samples, 95) * 1000, 3),
+        'p99': round(percentile(samples, 99) * 1000, 3),
+    }
+
+
+def payload(size):
+    """Something that looks like an encrypted WBO payload."""
+    data = os.urandom(size * 3 // 4)
+    return json.dumps({
+        'ciphertext': base64.b64encode(data).decode('ascii'),
+        'IV': base64.b64encode(os.urandom(16)).decode('ascii'),
+        'hmac': hashlib.sha256(data).hexdigest()})
+
+
+class Session(object):
+    """A single Firefox profile talking to the server."""
+
+    def __init__(self, app, uid, results, lock):
+        self.client = Client(app, Response)
+        self.uid = uid
+        self.results = results
+        self.lock = lock
+
+        auth = base64.b64encode(('%s:%s' % (uid, 'password')).encode('utf-8'))
+        self.headers = {'Authorization': 'Basic ' + auth.decode('ascii')}
+
+    def request(self, endpoint, method, path, data=None):
+        start = time.time()
+        rv = self.client.open(path, method=method, headers=self.headers,
+                              data=None if data is None else json.dumps(data))
+        rv.get_data()  # consume streamed responses
+        elapsed = time.time() - start
+
+        if rv.status_code >= 400:
+            raise RuntimeError('%s %s returned %i' % (method, path, rv.status_code))
+
+        with self.lock:
+            self.results.setdefault(endpoint, []).append(elapsed)
+        return rv
+
+    def register(self):
+        self.request('PUT /user/1.0/<uid>', 'PUT', '/user/1.0/%s' % self.uid,
+                     {'password': 'password'})
+
+    def upload(self, cid, records, batch, size):
+        for i in range(0, records, batch):
+            items = [{'id': '%s%08i' % (cid[0], j), 'payload': payload(size),
+                      'sortindex': random.randint(0, 1000),
+                      'parentid': 'folder%i' % (j % 50)}
+                     for j in range(i, min(records, i + batch))]
+            self.request('POST /1.1/<uid>/storage/<cid>', 'POST',
+                         '/1.1/%s/storage/%s' % (self.uid, cid), items)
+
+    def sync(self, changes, size):
+        """A regular sync: poll, fetch meta/global, upload and fetch changes."""
+
+        rv = self.request('GET /1.1/<uid>/info/collections', 'GET',
+                          '/1.1/%s/info/collections' % self.uid)
+        since = json.loads(rv.get_data(as_text=True)).get('history', 0)
+
+        self.request('GET /1.1/<uid>/storage/<cid>/<id>', 'GET',
+                     '/1.1/%s/storage/meta/global' % self.uid)
+
+        if changes:
+            items = [{'id': 'h%08i' % random.randint(0, 10**6), 'payload': payload(size)}
+                     for i in range(changes)]
+            self.request('POST /1.1/<uid>/storage/<cid>', 'POST',
+                         '/1.1/%s/storage/history' % self.uid, items)
+
+        self.request('GET /1.1/<uid>/storage/<cid>?newer=', 'GET',
+                     '/1.1/%s/storage/history?full=1&newer=%s' % (self.uid, since))
+
+    def run(self, options):
+        self.register()
+        self.request('PUT /1.1/<uid>/storage/<cid>/<id>', 'PUT',
+                     '/1.1/%s/storage/meta/global' % self.uid,
+                     {'payload': payload(options.size)})
+
+        for cid in ('bookmarks', 'history'):
+            self.upload(cid, options.records, options.batch, options.size)
+
+        for i in range(options.syncs):
+            self.sync(options.changes, options.size)
+
+
+def run(options):
+    """Run the benchmark described by `options` and return the report."""
+
+    from weave import make_app
+
+    data_dir = tempfile.mkdtemp(prefix='weave-bench-')
+    app = make_app(data_dir, register=True, pool_size=options.pool_size,
+                   sqlite_profile=options.sqlite_profile)
+
+    results, lock, errors = {}, threading.Lock(), []
+    sessions = [Session(app, 'bench%i' % i, results, lock) for i in range(options.users)]
+
+    def worker(sessions):
+        try:
+            for session in sessions:
+                session.run(options)
+        except Exception as ex:
+            errors.append(ex)
+
+    threads = [threading.Thread(target=worker, args=(sessions[i::options.concurrency], ))
+               for i in range(options.concurrency)]
+
+    start = time.time()
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        elapsed = time.time() - start
+        if not options.keep:
+            shutil.rmtree(data_dir)
+
+    if errors:
+        raise errors[0]
+
+    return {
+        'config': dict((k, v) for k, v in vars(options).items() if k != 'output'),
+        'elapsed': round(elapsed, 3),
+        'total': summarize(sum(results.values(), []), elapsed),
+        'endpoints': dict((k, summarize(v, elapsed)) for k, v in results.items()),
+    }
+
+
+def main(args=None):
+
+    parser = ArgumentParser(description="weave-minimal load generator")
+    option = parser.add_argument
+
+    option("--users", default=4, type=int, help="number of simulated clients")
+    option("--concurrency", default=1, type=int, help="number of client threads")
+    option("--records", default=1000, type=int,
+           help="bookmarks and history records uploaded per client")
+    option("--batch", default=100, type=int, help="records per POST")
+    option("--size", default=256, type=int, help="approximate payload size")
+    option("--syncs", default=50, type=int, help="incremental syncs per client")
+    option("--changes", default=5, type=int, help="records changed per sync")
+    option("--pool-size", dest="pool_size", default=64, type=int)
+    option("--sqlite-profile", dest="sqlite_profile", default="normal")
+    option("--keep", action="store_true", help="keep the temporary data directory")
+    option("--output", "-o", default=None, help="write JSON to a file")
+
+    options = parser.parse_args(args)
+    report = json.dumps(run(options), indent=2, sort_keys=True)
+
+    if options.output:
+        with open(options.output, 'w') as fp:
+            fp.write(report + '\n')
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+import time
+import threading
+
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """A thread-safe, bounded mapping that evicts the least recently used
+    entries first.
+
+    Values computed by :meth:`load` are only stored if no key has been
+    invalidated meanwhile, so a slow reader can not put a value into the
+    cache that has already been outdated by a concurrent write.
+
+    :param size: maximum number of entries
+    :param ttl: seconds after which an entry is considered stale, optional
+    :param capacity: maximum size of all values in bytes as returned by
+                     `weigh`, optional
+    """
+
+    def __init__(self, size=1024, ttl=None, capacity=None, weigh=len):
+        self.size = size
+        self.ttl = ttl
+        self.capacity = capacity
+        self.weigh = weigh
+        self.lock = threading.Lock()
+        self.data = OrderedDict()
+        self.generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.resident = 0  # bytes, only with a capacity
+
+    def __len__(self):
+        return len(self.data)
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'entries': len(self.data),
+                    'bytes': self.resident}
+
+    def insert(self, key, value):
+        """Add an entry, must be called with the lock held."""
+        self.data[key] = (None if self.ttl is None else time.time() + self.ttl), value
+        if self.capacity is not None:
+            self.resident += self.weigh(value)
+
+    def remove(self, key):
+        """Remove an entry, must be called with the lock held."""
+        expires, value = self.data.pop(key)
+        if self.capacity is not None:
+            self.resident -= self.weigh(value)
+
+    def full(self):
+        if len(self.data) > self.size:
+            return True
+        return self.capacity is not None and self.resident > self.capacity
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                expires, value = self.data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires < time.time():
+                self.remove(key)
+                self.misses += 1
+                return default
+            self.data[key] = self.data.pop(key)  # most recently used
+            self.hits += 1
+            return value
+
+    def set(self, key, value, generation=None):
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            if key in self.data:
+                self.remove(key)
+            self.insert(key, value)
+            while self.data and self.full():
+                self.remove(next(iter(self.data)))
+                self.evictions += 1
+
+    def load(self, key, func):
+        """Return the cached value for `key` or compute it using `func`."""
+
+        rv = self.get(key, self)
+        if rv is not self:
+            return rv
+
+        generation = self.generation
+        rv = func()
+        self.set(key, rv, generation)
+        return rv
+
+    def invalidate(self, key):
+        with self.lock:
+            self.generation += 1
+            if key in self.data:
+                self.remove(key)
+
+
+class RecordCache(LRUCache):
+    """Item GET responses by (store, collection, id), bounded by the number of
+    entries and the size of the serialized items.  Invalidated per
+    collection by (store, collection).
+
+    :param size: maximum number of entries
+    :param capacity: maximum size in bytes
+    """
+
+    def __init__(self, size=4096, capacity=8 * 1024 * 1024):
+        super(RecordCache, self).__init__(
+            size, capacity=capacity, weigh=lambda value: len(value[2]) if value else 0)
+        self.collections = {}  # (store, collection) -> set of ids
+
+    def insert(self, key, value):
+        super(RecordCache, self).insert(key, value)
+        self.collections.setdefault(key[:2], set()).add(key[2])
+
+    def remove(self, key):
+        super(RecordCache, self).remove(key)
+        ids = self.collections[key[:2]]
+        ids.discard(key[2])
+        if not ids:
+            del self.collections[key[:2]]
+
+    def invalidate(self, key):
+        """Drop all items of the (store, collection) `key`."""
+        with self.lock:
+            self.generation += 1
+            for id in list(self.collections.get(key, ())):
+                self.remove(key + (id, ))
+
+    def discard(self, store):
+        """Drop all items of a store."""
+        with self.lock:
+            self.generation += 1
+            for key in [key for key in self.collections if key[0] == store]:
+                for id in list(self.collections[key]):
+                    self.remove(key + (id, ))
@@ -9,8 +9,10 @@ import sys
 PY2K = sys.version_info[0] == 2
 
 if not PY2K:
+    string_types = (str, )
     iterkeys = lambda d: iter(d.keys())
     iteritems = lambda d: iter(d.items())
 else:
+    string_types = (basestring, )
     iterkeys = lambda d: d.iterkeys()
     iteritems = lambda d: d.iteritems()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+import io
+import zlib
+import itertools
+import threading
+
+from werkzeug.http import parse_accept_header
+from werkzeug.exceptions import RequestEntityTooLarge
+
+from weave.minimal.utils import Request, BadRequest
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# content types worth compressing
+TYPES = ('application/json', 'application/newlines', 'application/whoisi',
+         'application/javascript', 'text/')
+
+
+def compressor(encoding, level):
+    """Returns a (compress, finish) pair of functions for `encoding`."""
+
+    if encoding == 'br':
+        obj = brotli.Compressor(quality=level)
+        return obj.process, obj.finish
+
+    obj = zlib.compressobj(level, zlib.DEFLATED,
+                           zlib.MAX_WBITS | (16 if encoding == 'gzip' else 0))
+    return obj.compress, obj.flush
+
+
+class Compression(object):
+    """WSGI middleware compressing responses with gzip, deflate or, if the
+    brotli module is installed, br as negotiated by Accept-Encoding.
+
+    Bodies are compressed while they are streamed.  Up to `threshold` bytes
+    are buffered first, smaller responses are sent as they are.  Request
+    bodies with a Content-Encoding of gzip or deflate are decompressed, but
+    not beyond `max_size` bytes.
+
+    :param level: compression level, 1 (fast) to 9 (small)
+    :param threshold: minimum response size in bytes
+    :param max_size: maximum size of a decompressed request body
+    """
+
+    def __init__(self, level=6, threshold=1024, max_size=Request.max_content_length):
+        self.level = level
+        self.threshold = threshold
+        self.max_size = max_size
+        self.lock = threading.Lock()
+
+        self.encodings = ['gzip', 'deflate']
+        if brotli is not None:
+            self.encodings.insert(0, 'br')
+
+        self.bytes_in = 0   # uncompressed size of compressed responses
+        self.bytes_out = 0
+
+    def stats(self):
+        with self.lock:
+            return {'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out,
+                    'bytes_saved': self.bytes_in - self.bytes_out}
+
+    def negotiate(self, value):
+        """The preferred encoding acceptable to the client or None."""
+        accept = parse_accept_header(value)
+        quality, encoding = max((accept.quality(enc), -i, enc)
+                                for i, enc in enumerate(self.encodings))[::2]
+        return encoding if quality > 0 else None
+
+    def compressible(self, status, headers):
+        if status[:3] in ('204', '304') or int(status[:3]) < 200:
+            return False
+        headers = dict((k.lower(), v) for k, v in headers)
+        if 'content-encoding' in headers:
+            return False
+        return headers.get('content-type', '').startswith(TYPES)
+
+    def inflate(self, environ):
+        """Replace a compressed request body by its decompressed content, returns
+        an error response if the body is invalid or too large."""
+
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            return BadRequest()
+        if length > self.max_size:
+            return RequestEntityTooLarge()
+
+        obj = zlib.decompressobj(zlib.MAX_WBITS | 32)  # gzip or zlib header
+        try:
+            data = obj.decompress(environ['wsgi.input'].read(length), self.max_size + 1)
+        except zlib.error:
+            return BadRequest()
+        if len(data) > self.max_size or obj.unconsumed_tail:
+            return RequestEntityTooLarge()
+
+        environ['wsgi.input'] = io.BytesIO(data)
+        environ['CONTENT_LENGTH'] = str(len(data))
+        del environ['HTTP_CONTENT_ENCODING']
+
+    def wrap(self, app):
+
+        def wrapper(environ, start_response):
+
+            if environ.get('HTTP_CONTENT_ENCODING', '').lower() in ('gzip', 'deflate'):
+                error = self.inflate(environ)
+                if error is not None:
+                    return error(environ, start_response)
+
+            encoding = None
+            if environ.get('REQUEST_METHOD') != 'HEAD':
+                encoding = self.negotiate(environ.get('HTTP_ACCEPT_ENCODING', ''))
+            if encoding is None:
+                return app(environ, start_response)
+
+            response = []
+
+            def capture(status, headers, exc_info=None):
+                response[:] = status, headers, exc_info
+                return lambda data: None  # write() is not supported
+
+            body = app(environ, capture)
+            return self.compress(body, response, start_response, encoding)
+
+        return wrapper
+
+    def compress(self, body, response, start_response, encoding):
+
+        chunks, buffered, size = iter(body), [], 0
+        try:
+            for chunk in chunks:
+                buffered.append(chunk)
+                size += len(chunk)
+                if size >= self.threshold:
+                    break
+            else:
+                chunks = None
+
+            status, headers, exc_info = response
+            if (chunks is None and size < self.threshold) or \
+                    not self.compressible(status, headers):
+                start_response(status, headers, exc_info)
+                for chunk in itertools.chain(buffered, chunks or ()):
+                    yield chunk
+                return
+
+            rv = [('Content-Encoding', encoding), ('Vary', 'Accept-Encoding')]
+            for key, value in headers:
+                name = key.lower()
+                if name == 'etag' and value.startswith('"'):
+                    value = 'W/' + value  # a different representation
+                elif name == 'vary':
+                    rv[1] = ('Vary', value + ', Accept-Encoding')
+                    continue
+                elif name == 'content-length':
+                    continue
+                rv.append((key, value))
+            start_response(status, rv, exc_info)
+
+            process, finish = compressor(encoding, self.level)
+            size, compressed = 0, 0
+            try:
+                for chunk in itertools.chain(buffered, chunks or ()):
+                    size += len(chunk)
+                    data = process(chunk)
+                    if data:
+                        compressed += len(data)
+                        yield data
+                data = finish()
+                compressed += len(data)
+                yield data
+            finally:
+                with self.lock:
+                    self.bytes_in += size
+                    self.bytes_out += compressed
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+
@@ -6,3 +6,4 @@ WEAVE_MALFORMED_JSON = "6"        # Json parse failure
 WEAVE_MISSING_PASSWORD = "7"      # Missing password field
 WEAVE_INVALID_WBO = "8"           # Invalid Weave Basic Object
 WEAVE_WEAK_PASSWORD = "9"         # Requested password not strong enough
+WEAVE_OVER_QUOTA = "14"           # User over quota
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+import time
+import logging
+import threading
+
+from weave.minimal.utils import shard
+
+logger = logging.getLogger("weave-minimal")
+
+
+class Sweeper(threading.Thread):
+    """Background worker that deletes expired items of all users every
+    `interval` seconds.  Requests skip expired items on their own, so
+    nothing is deleted on the request path.
+
+    With pre-forked workers, each worker passes its `shard` (index, workers)
+    and only expires the users routed to it, so the caches of the process
+    serving a user are invalidated.
+    """
+
+    def __init__(self, app, interval, shard=None):
+        super(Sweeper, self).__init__(name="weave-sweeper")
+        self.daemon = True
+
+        self.app = app
+        self.interval = interval
+        self.shard = shard
+
+        self.sweeps = 0
+        self.reclaimed = 0
+        self.last_reclaimed = 0
+        self.last_duration = 0.0
+
+    def stats(self):
+        return {'sweeps': self.sweeps, 'reclaimed': self.reclaimed,
+                'last_reclaimed': self.last_reclaimed,
+                'last_duration': self.last_duration}
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.sweep()
+            except Exception:
+                logger.exception("unable to expire items")
+
+    def sweep(self):
+        start, now, rows = time.time(), time.time(), 0
+
+        users = None
+        if self.shard is not None:
+            index, workers = self.shard
+            users = lambda uid: shard(uid, workers) == index
+
+        for key, n in self.app.backend.expire(now, users):
+            if n:
+                self.app.metadata.invalidate(key)
+                self.app.records.discard(key)
+                rows += n
+
+        self.sweeps += 1
+        self.reclaimed += rows
+        self.last_reclaimed = rows
+        self.last_duration = time.time() - start
+
+        logger.info("expired %i items in %.2fs", rows, self.last_duration)
+        return rows
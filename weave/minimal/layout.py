@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+import os
+import re
+import time
+import errno
+import hashlib
+import logging
+import threading
+
+from os.path import join, dirname, basename, isdir, isfile
+
+logger = logging.getLogger("weave-minimal")
+
+SUFFIXES = ('', '-wal', '-shm')
+
+
+def move(src, dst):
+    """Move a database including its write-ahead log."""
+
+    try:
+        os.makedirs(dirname(dst))
+    except OSError as ex:
+        if ex.errno != errno.EEXIST:
+            raise
+
+    for suffix in SUFFIXES:
+        if isfile(src + suffix):
+            os.rename(src + suffix, dst + suffix)
+
+
+class Flat(object):
+    """All databases in the data directory, named `<uid>.<crypt>`.
+
+    Whether a user exists is answered from an in-memory index of all users,
+    built by listing the data directory.  Accounts created by another
+    process are found by listing it again on a miss, at most every
+    `rescan` seconds.
+    """
+
+    rescan = 5
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self.lock = threading.Lock()
+        self.users = None  # uid -> set of database paths, see `accounts`
+        self.scanned = 0
+
+    def path(self, uid, crypt):
+        return join(self.data_dir, uid + '.' + crypt)
+
+    def split(self, dbpath):
+        """The (uid, crypt) of a database path."""
+        return tuple(basename(dbpath).rsplit('.', 1))
+
+    def find(self, uid, crypt):
+        dbpath = self.path(uid, crypt)
+        return dbpath if isfile(dbpath) else None
+
+    def iterdbs(self):
+        """Yields the path of every user database."""
+        for name in os.listdir(self.data_dir):
+            if re.match(r'^[a-zA-Z0-9._-]+\.[0-9a-f]{16}$', name):
+                yield join(self.data_dir, name)
+
+    def scan(self):
+        """Build the index, must be called with the lock held."""
+
+        users = {}
+        for dbpath in self.iterdbs():
+            users.setdefault(self.split(dbpath)[0], set()).add(dbpath)
+        self.users, self.scanned = users, time.time()
+
+    def accounts(self):
+        """In-memory index of all users, built from the data directory."""
+
+        if self.users is None:
+            with self.lock:
+                if self.users is None:
+                    self.scan()
+        return self.users
+
+    def exists(self, uid):
+        if self.accounts().get(uid):
+            return True
+
+        with self.lock:
+            if time.time() - self.scanned >= self.rescan:
+                self.scan()
+            return bool(self.users.get(uid))
+
+    def created(self, uid, dbpath):
+        self.accounts()
+        with self.lock:
+            self.users.setdefault(uid, set()).add(dbpath)
+
+    def removed(self, uid, dbpath):
+        self.accounts()
+        with self.lock:
+            self.users.get(uid, set()).discard(dbpath)
+
+
+class Sharded(object):
+    """Databases in `<ab>/<cd>/<uid>/<crypt>` where ab and cd are taken from
+    the SHA-1 of the uid, so no directory grows with the number of users and
+    whether a user exists is a single stat call.
+
+    Databases still in the flat layout are moved on first login, see
+    :func:`migrate` to move all of them at once.
+    """
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self.lock = threading.Lock()
+        self.legacy = Flat(data_dir)
+
+    def home(self, uid):
+        digest = hashlib.sha1(uid.encode('utf-8')).hexdigest()
+        return join(self.data_dir, digest[:2], digest[2:4], uid)
+
+    def path(self, uid, crypt):
+        return join(self.home(uid), crypt)
+
+    def split(self, dbpath):
+        return basename(dirname(dbpath)), basename(dbpath)
+
+    def find(self, uid, crypt):
+        dbpath = self.path(uid, crypt)
+        if isfile(dbpath):
+            return dbpath
+
+        with self.lock:
+            if isfile(dbpath):  # moved by a concurrent request
+                return dbpath
+            legacy = self.legacy.find(uid, crypt)
+            if legacy is None:
+                return None
+            move(legacy, dbpath)
+            self.legacy.removed(uid, legacy)
+
+        logger.info("moved `%s` to `%s`", legacy, dbpath)
+        return dbpath
+
+    def iterdbs(self):
+        """Yields the path of every user database (in this layout)."""
+
+        for a in os.listdir(self.data_dir):
+            if not re.match(r'^[0-9a-f]{2}$', a):
+                continue
+            if not isdir(join(self.data_dir, a)):
+                continue
+            for b in os.listdir(join(self.data_dir, a)):
+                for uid in os.listdir(join(self.data_dir, a, b)):
+                    for name in os.listdir(join(self.data_dir, a, b, uid)):
+                        if re.match(r'^[0-9a-f]{16}$', name):
+                            yield join(self.data_dir, a, b, uid, name)
+
+    def exists(self, uid):
+        return isdir(self.home(uid)) or self.legacy.exists(uid)
+
+    def created(self, uid, dbpath):
+        pass
+
+    def removed(self, uid, dbpath):
+        try:
+            os.rmdir(dirname(dbpath))
+        except OSError:
+            pass  # not empty
+
+
+LAYOUTS = {'flat': Flat, 'sharded': Sharded}
+
+
+def migrate(data_dir, source, target):
+    """Move all databases from the `source` to the `target` layout, returns
+    the number of moved databases.  The server must not run meanwhile."""
+
+    src, dst = LAYOUTS[source](data_dir), LAYOUTS[target](data_dir)
+
+    n = 0
+    for dbpath in list(src.iterdbs()):
+        uid, crypt = src.split(dbpath)
+        move(dbpath, dst.path(uid, crypt))
+        src.removed(uid, dbpath)
+        n += 1
+
+    logger.info("moved %i databases to the %s layout", n, target)
+    return n
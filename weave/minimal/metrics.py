@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+import re
+import time
+import sqlite3
+import logging
+import threading
+
+from werkzeug.wrappers import Response
+from werkzeug.serving import make_server
+
+from weave.minimal.cache import LRUCache
+
+logger = logging.getLogger("weave-minimal")
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+# SQLite time spent by the current request (thread or greenlet)
+local = threading.local()
+
+
+def label(value):
+    """Escape a Prometheus label value."""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def route(rule):
+    """/<float:version>/<re(...):uid>/info/quota -> /{version}/{uid}/info/quota"""
+    if rule is None:
+        return 'unmatched'
+    return re.sub(r'<(?:[^<>]*:)?(\w+)>', r'{\1}', rule.rule)
+
+
+def timed(func):
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            local.sqlite = getattr(local, 'sqlite', 0.0) + time.time() - start
+    return wrapper
+
+
+class Cursor(sqlite3.Cursor):
+    """Cursor accounting the time spent in SQLite to the current request."""
+
+    execute = timed(sqlite3.Cursor.execute)
+    executemany = timed(sqlite3.Cursor.executemany)
+    fetchone = timed(sqlite3.Cursor.fetchone)
+    fetchmany = timed(sqlite3.Cursor.fetchmany)
+    fetchall = timed(sqlite3.Cursor.fetchall)
+    __next__ = timed(sqlite3.Cursor.__next__)
+
+
+class Connection(sqlite3.Connection):
+
+    def cursor(self, factory=Cursor):
+        return super(Connection, self).cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, parameters):
+        return self.cursor().executemany(sql, parameters)
+
+
+class Histogram(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def render(self, name, labels):
+        for bound, count in zip(self.buckets, self.counts):
+            yield '%s_bucket{%s,le="%s"} %i' % (name, labels, bound, count)
+        yield '%s_bucket{%s,le="+Inf"} %i' % (name, labels, self.count)
+        yield '%s_sum{%s} %s' % (name, labels, self.sum)
+        yield '%s_count{%s} %i' % (name, labels, self.count)
+
+
+class Metrics(object):
+    """Collects per-route request counts, latency, response size and SQLite
+    time histograms plus connection pool, cache and expiry statistics of
+    `app`, rendered in the Prometheus text exposition format.
+
+    :param app: the :class:`weave.Weave` instance
+    :param path: serve the metrics on this path of the application, optional
+    """
+
+    def __init__(self, app, path=None):
+        self.app = app
+        self.path = path
+        self.lock = threading.Lock()
+
+        self.requests = {}  # (route, method, status) -> count
+        self.latency = {}   # route -> Histogram
+        self.sizes = {}     # route -> Histogram
+        self.sqlite = {}    # route -> Histogram
+
+        app.pool.factory = Connection
+
+    def observe(self, route, method, status, elapsed, size, sqlite):
+        with self.lock:
+            key = route, method, status
+            self.requests[key] = self.requests.get(key, 0) + 1
+            for hists, buckets, value in ((self.latency, LATENCY_BUCKETS, elapsed),
+                                          (self.sizes, SIZE_BUCKETS, size),
+                                          (self.sqlite, LATENCY_BUCKETS, sqlite)):
+                if route not in hists:
+                    hists[route] = Histogram(buckets)
+                hists[route].observe(value)
+
+    def wrap(self, dispatch):
+        """Wrap :meth:`weave.Weave.dispatch`.  Streamed responses are observed
+        when the body has been sent (or the client went away)."""
+
+        def wrapper(request, start_response):
+
+            if self.path is not None and request.path == self.path:
+                return Response(self.render(), 200,
+                                content_type='text/plain; version=0.0.4')
+
+            local.sqlite = 0.0
+            start = time.time()
+            response = dispatch(request, start_response)
+
+            name = route(getattr(request, 'url_rule', None))
+            status = getattr(response, 'status_code', getattr(response, 'code', 0))
+
+            if not isinstance(response, Response) or not response.is_streamed:
+                size = response.calculate_content_length() \
+                    if isinstance(response, Response) else 0
+                self.observe(name, request.method, status, time.time() - start,
+                             size or 0, local.sqlite)
+                return response
+
+            def iterate(body):
+                size = 0
+                try:
+                    for chunk in body:
+                        size += len(chunk)
+                        yield chunk
+                finally:
+                    if hasattr(body, 'close'):
+                        body.close()
+                    self.observe(name, request.method, status, time.time() - start,
+                                 size, local.sqlite)
+
+            response.response = iterate(response.response)
+            return response
+
+        return wrapper
+
+    def render(self):
+        lines = []
+        add = lines.append
+
+        with self.lock:
+            add('# TYPE weave_requests_total counter')
+            for (name, method, status), count in sorted(self.requests.items()):
+                add('weave_requests_total{route="%s",method="%s",status="%s"} %i' % (
+                    label(name), label(method), status, count))
+
+            for name, hists in (('weave_request_duration_seconds', self.latency),
+                                ('weave_response_size_bytes', self.sizes),
+                                ('weave_sqlite_duration_seconds', self.sqlite)):
+                add('# TYPE %s histogram' % name)
+                for key, hist in sorted(hists.items()):
+                    lines.extend(hist.render(name, 'route="%s"' % label(key)))
+
+        stats = self.app.pool.stats()
+        add('# TYPE weave_pool_connections gauge')
+        for state in ('idle', 'busy'):
+            add('weave_pool_connections{state="%s"} %i' % (state, stats[state]))
+        for key in ('hits', 'misses', 'evictions'):
+            add('# TYPE weave_pool_%s_total counter' % key)
+            add('weave_pool_%s_total %i' % (key, stats[key]))
+
+        caches = sorted((k, v) for k, v in vars(self.app).items() if isinstance(v, LRUCache))
+        for key in ('hits', 'misses', 'evictions', 'entries'):
+            if key == 'entries':
+                add('# TYPE weave_cache_entries gauge')
+            else:
+                add('# TYPE weave_cache_%s_total counter' % key)
+            for name, cache in caches:
+                add('weave_cache_%s%s{cache="%s"} %i' % (
+                    key, '' if key == 'entries' else '_total', label(name),
+                    cache.stats()[key]))
+        add('# TYPE weave_cache_bytes gauge')
+        for name, cache in caches:
+            add('weave_cache_bytes{cache="%s"} %i' % (label(name), cache.stats()['bytes']))
+        add('# TYPE weave_cache_hit_ratio gauge')
+        for name, cache in caches:
+            stats = cache.stats()
+            add('weave_cache_hit_ratio{cache="%s"} %s' % (
+                label(name), stats['hits'] / float(stats['hits'] + stats['misses'] or 1)))
+
+        admission = getattr(self.app, 'admission', None)
+        if admission is not None:
+            budgets = (('read', admission.reads), ('write', admission.writes))
+            for key, kind in (('inflight', 'gauge'), ('waiting', 'gauge'),
+                              ('rejected', 'counter')):
+                name = 'weave_admission_%s%s' % (key, '_total' if kind == 'counter' else '')
+                add('# TYPE %s %s' % (name, kind))
+                for budget_name, budget in budgets:
+                    add('%s{budget="%s"} %i' % (name, budget_name, getattr(budget, key)))
+            add('# TYPE weave_admission_latency_seconds gauge')
+            for budget_name, budget in budgets:
+                add('weave_admission_latency_seconds{budget="%s"} %s' % (
+                    budget_name, budget.latency))
+
+        compression = getattr(self.app, 'compression', None)
+        if compression is not None:
+            stats = compression.stats()
+            for key in ('bytes_in', 'bytes_out', 'bytes_saved'):
+                add('# TYPE weave_compression_%s_total counter' % key)
+                add('weave_compression_%s_total %i' % (key, stats[key]))
+
+        writer = getattr(self.app, 'writer', None)
+        if writer is not None:
+            stats = writer.stats()
+            for key in ('batches', 'jobs', 'failed'):
+                add('# TYPE weave_writer_%s_total counter' % key)
+                add('weave_writer_%s_total %i' % (key, stats[key]))
+
+        sweeper = getattr(self.app, 'sweeper', None)
+        if sweeper is not None:
+            stats = sweeper.stats()
+            add('# TYPE weave_expiry_sweeps_total counter')
+            add('weave_expiry_sweeps_total %i' % stats['sweeps'])
+            add('# TYPE weave_expiry_reclaimed_total counter')
+            add('weave_expiry_reclaimed_total %i' % stats['reclaimed'])
+            add('# TYPE weave_expiry_last_reclaimed gauge')
+            add('weave_expiry_last_reclaimed %i' % stats['last_reclaimed'])
+            add('# TYPE weave_expiry_last_duration_seconds gauge')
+            add('weave_expiry_last_duration_seconds %s' % stats['last_duration'])
+
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, host, port):
+        """Serve the metrics on a separate port from a background thread."""
+
+        def application(environ, start_response):
+            return Response(self.render(), 200, content_type='text/plain; version=0.0.4')(
+                environ, start_response)
+
+        server = make_server(host, port, application, threaded=True)
+        thread = threading.Thread(target=server.serve_forever, name="weave-metrics")
+        thread.daemon = True
+        thread.start()
+
+        logger.info("serving metrics on http://%s:%i/", host, port)
+        return server
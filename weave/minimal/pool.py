@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+import sqlite3
+import threading
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class Pool(object):
+    """A bounded pool of open SQLite connections, keyed by database path.
+
+    Connections are checked out for the duration of a request and returned
+    afterwards, so a connection is never shared between two threads (or
+    greenlets) at the same time.  At most `size` idle connections are kept;
+    when the pool is full, the connections of the least recently used
+    database are closed.
+
+    :param size: maximum number of idle connections
+    :param setup: called with each newly opened connection
+    :param factory: the connection class, see :func:`sqlite3.connect`
+    :param statements: prepared statements cached per connection
+    """
+
+    def __init__(self, size=64, setup=None, factory=sqlite3.Connection, statements=256):
+        self.size = size
+        self.setup = setup
+        self.factory = factory
+        self.statements = statements
+        self.lock = threading.Lock()
+
+        self.idle = OrderedDict()  # dbpath -> [connection, ...]
+        self.busy = {}             # id(connection) -> dbpath
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(cons) for cons in self.idle.values()) + len(self.busy)
+
+    def stats(self):
+        with self.lock:
+            idle = sum(len(cons) for cons in self.idle.values())
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'idle': idle,
+                    'busy': len(self.busy)}
+
+    def open(self, dbpath):
+        con = sqlite3.connect(dbpath, check_same_thread=False, factory=self.factory,
+                              cached_statements=self.statements)
+        if self.setup is not None:
+            self.setup(con)
+        return con
+
+    def acquire(self, dbpath):
+        with self.lock:
+            cons = self.idle.get(dbpath)
+            if cons:
+                con = cons.pop()
+                if not cons:
+                    del self.idle[dbpath]
+                self.hits += 1
+            else:
+                con = None
+                self.misses += 1
+
+        if con is None:
+            con = self.open(dbpath)
+
+        with self.lock:
+            self.busy[id(con)] = dbpath
+        return con
+
+    def release(self, con):
+        with self.lock:
+            dbpath = self.busy.pop(id(con), None)
+            if dbpath is not None:
+                self.idle.setdefault(dbpath, []).append(con)
+                self.idle[dbpath] = self.idle.pop(dbpath)  # most recently used
+                con, evicted = None, self.evict()
+            else:
+                evicted = []  # discarded while checked out
+
+        for x in evicted + [con]:
+            if x is not None:
+                x.close()
+
+    def evict(self):
+        """Remove idle connections of least recently used databases until the
+        pool fits into its size again.  Must be called with the lock held."""
+
+        rv = []
+        while sum(len(cons) for cons in self.idle.values()) > self.size:
+            dbpath, cons = next(iter(self.idle.items()))
+            rv.append(cons.pop(0))
+            if not cons:
+                del self.idle[dbpath]
+            self.evictions += 1
+        return rv
+
+    def discard(self, dbpath):
+        """Close all connections to `dbpath`, e.g. before the database file is
+        removed or renamed.  Checked out connections are closed on release."""
+
+        with self.lock:
+            cons = self.idle.pop(dbpath, [])
+            for key, value in list(self.busy.items()):
+                if value == dbpath:
+                    del self.busy[key]
+
+        for con in cons:
+            con.close()
+
+    @contextmanager
+    def connect(self, dbpath):
+        """Check out a connection for `dbpath` and commit (or rollback on
+        error) when leaving the block, like ``with sqlite3.connect(...)``."""
+
+        con = self.acquire(dbpath)
+        try:
+            with con:
+                yield con
+        finally:
+            self.release(con)
@@ -0,0 +1,410 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""Pre-fork server mode, POSIX only.
+
+A master process forks a number of workers, each serving its own copy of
+the application on a private localhost port, and forwards every request to
+the worker its user is assigned to.  All requests of a user end up in the
+same process, so a user's database is never written from two processes at
+once and the per-process connection pool and caches stay warm.
+"""
+
+from __future__ import division
+
+import os
+import sys
+import json
+import time
+import fcntl
+import errno
+import select
+import signal
+import socket
+import logging
+import threading
+
+try:
+    from http.client import HTTPConnection, HTTPException
+except ImportError:
+    from httplib import HTTPConnection, HTTPException
+
+from werkzeug.serving import make_server
+
+from weave.minimal.utils import partition, shard
+
+logger = logging.getLogger("weave-minimal")
+
+HOP_BY_HOP = frozenset(['connection', 'keep-alive', 'proxy-authenticate',
+                        'proxy-authorization', 'te', 'trailer', 'transfer-encoding',
+                        'upgrade'])
+
+CHUNK_SIZE = 64 * 1024
+
+
+def route(path, workers):
+    """The index of the worker serving the user of `path`."""
+    return shard(partition(path) or '', workers)
+
+
+class Inflight(object):
+    """Counts the requests (including streamed responses) of a worker, so it
+    can finish them before it exits."""
+
+    def __init__(self, app):
+        self.app = app
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def incr(self, n):
+        with self.lock:
+            self.count += n
+
+    def __call__(self, environ, start_response):
+        self.incr(1)
+        try:
+            body = self.app(environ, start_response)
+        except Exception:
+            self.incr(-1)
+            raise
+        return self.drain(body)
+
+    def drain(self, body):
+        try:
+            for chunk in body:
+                yield chunk
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+            self.incr(-1)
+
+    def wait(self, timeout):
+        deadline = time.time() + timeout
+        while self.count > 0 and time.time() < deadline:
+            time.sleep(0.05)
+
+
+class Worker(object):
+    """A forked worker as seen by the master."""
+
+    def __init__(self, index, pid, port):
+        self.index = index
+        self.pid = pid
+        self.port = port
+        self.started = time.time()
+        self.restarts = 0
+        self.requests = 0
+        self.errors = 0
+        self.latency = 0.0  # moving average in seconds
+
+    def observe(self, elapsed, error):
+        self.requests += 1
+        self.errors += int(error)
+        self.latency += (elapsed - self.latency) * 0.05
+
+    @property
+    def alive(self):
+        try:
+            os.kill(self.pid, 0)
+        except OSError:
+            return False
+        return True
+
+    def health(self):
+        return {'worker': self.index, 'pid': self.pid, 'port': self.port,
+                'alive': self.alive, 'uptime': round(time.time() - self.started),
+                'restarts': self.restarts, 'requests': self.requests,
+                'errors': self.errors, 'latency': round(self.latency * 1000, 2)}
+
+
+class Master(object):
+    """Forks `workers` processes and routes each request to a worker by the
+    hash of the uid in the URL.
+
+    SIGHUP replaces the workers one after another: the new worker is started
+    and takes over the users first, the old one stops accepting connections
+    and exits once its requests are finished.  Workers that die are forked
+    again.  SIGINT and SIGTERM stop the master and all workers.
+
+    :param factory: called with the index of the worker in the forked
+                    process, returns the application
+    :param workers: number of worker processes
+    :param prefix: path prefix of the application (of the base URL), stripped
+                   before looking up the uid
+    :param health_path: serve the state of each worker as JSON on this path
+    :param timeout: seconds to wait for a worker to start or drain
+    """
+
+    def __init__(self, factory, workers, prefix=None, health_path=None, timeout=30):
+        self.factory = factory
+        self.workers = [None] * workers
+        self.prefix = prefix
+        self.health_path = health_path
+        self.timeout = timeout
+
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.server = None
+        self.retired = {}  # pid -> Worker, draining after a reload
+        self.signals = []
+
+    def spawn(self, index):
+        """Fork the worker `index` and wait until it listens."""
+
+        r, w = os.pipe()
+        pid = os.fork()
+
+        if pid == 0:
+            os.close(r)
+            try:
+                self.child(index, w)
+            except Exception:
+                logger.exception("worker %i failed", index)
+            finally:
+                os._exit(1)
+
+        os.close(w)
+        try:
+            ready, _, _ = select.select([r], [], [], self.timeout)
+            port = int(os.read(r, 16) or 0) if ready else 0
+        finally:
+            os.close(r)
+
+        if not port:
+            self.kill(pid, signal.SIGKILL)
+            raise RuntimeError("worker %i did not start" % index)
+
+        logger.info("worker %i (pid %i) listening on 127.0.0.1:%i", index, pid, port)
+        return Worker(index, pid, port)
+
+    def child(self, index, fd):
+        """Serve the application in the forked process until SIGTERM."""
+
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)  # the master stops us
+        if self.server is not None:
+            self.server.socket.close()
+
+        app = Inflight(self.factory(index))
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+
+        def stop(signum, frame):
+            threading.Thread(target=server.shutdown).start()
+
+        signal.signal(signal.SIGTERM, stop)
+
+        os.write(fd, str(server.server_port).encode('ascii'))
+        os.close(fd)
+
+        server.serve_forever()
+        app.wait(self.timeout)
+        os._exit(0)
+
+    def kill(self, pid, signum=signal.SIGTERM):
+        try:
+            os.kill(pid, signum)
+        except OSError as ex:
+            if ex.errno != errno.ESRCH:
+                raise
+
+    def reap(self):
+        """Collect exited workers, fork the ones that died unexpectedly."""
+
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as ex:
+                if ex.errno == errno.ECHILD:
+                    return
+                raise
+            if pid == 0:
+                return
+
+            if pid in self.retired:
+                del self.retired[pid]
+                continue
+
+            for i, worker in enumerate(self.workers):
+                if worker is not None and worker.pid == pid:
+                    logger.warning("worker %i (pid %i) died with status %i, restarting",
+                                   i, pid, status)
+                    replacement = self.spawn(i)
+                    replacement.restarts = worker.restarts + 1
+                    with self.lock:
+                        self.workers[i] = replacement
+
+    def reload(self):
+        logger.info("reloading %i workers", len(self.workers))
+        for i, old in enumerate(self.workers):
+            new = self.spawn(i)
+            new.restarts = old.restarts
+            with self.lock:
+                self.workers[i] = new
+            self.retired[old.pid] = old
+            self.kill(old.pid)
+
+    def stop(self):
+        for worker in self.workers + list(self.retired.values()):
+            if worker is not None:
+                self.kill(worker.pid)
+
+        deadline = time.time() + self.timeout
+        while time.time() < deadline:
+            try:
+                if os.waitpid(-1, os.WNOHANG)[0] == 0:
+                    time.sleep(0.1)
+            except OSError:
+                break  # no children left
+
+    def connection(self, worker, fresh=False):
+        """A keep-alive connection to `worker`, one per proxy thread."""
+
+        cache = self.local.__dict__
+        if fresh or cache.get(worker.pid) is None:
+            if worker.pid in cache:
+                cache[worker.pid].close()
+            cache[worker.pid] = HTTPConnection('127.0.0.1', worker.port, timeout=300)
+        return cache[worker.pid]
+
+    def forward(self, worker, environ, body):
+        headers = {}
+        for key, value in environ.items():
+            if key.startswith('HTTP_'):
+                name = key[5:].replace('_', '-').title()
+            elif key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                name = key.replace('_', '-').title()
+            else:
+                continue
+            if name.lower() not in HOP_BY_HOP and value:
+                headers[name] = value
+        headers['X-Forwarded-For'] = ', '.join(filter(None, [
+            environ.get('HTTP_X_FORWARDED_FOR'), environ.get('REMOTE_ADDR')]))
+
+        path = environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', '')
+        if environ.get('QUERY_STRING'):
+            path += '?' + environ['QUERY_STRING']
+
+        # a kept-alive connection may have been closed by the worker meanwhile
+        for fresh in (False, True):
+            con = self.connection(worker, fresh)
+            try:
+                con.request(environ['REQUEST_METHOD'], path, body, headers)
+                return con, con.getresponse()
+            except (HTTPException, socket.error):
+                if fresh:
+                    raise
+
+    def dispatch(self, index, environ, body):
+        """Forward to worker `index`.  Refused connections are retried until
+        a worker that died or is being replaced listens again."""
+
+        begin = time.time()
+        while True:
+            with self.lock:
+                worker = self.workers[index]
+            try:
+                return worker, self.forward(worker, environ, body)
+            except socket.error as ex:
+                if ex.errno != errno.ECONNREFUSED or time.time() - begin > self.timeout:
+                    raise
+            time.sleep(0.05)
+
+    def health(self, environ, start_response):
+        body = json.dumps([w.health() for w in self.workers], indent=2).encode('utf-8')
+        start_response('200 OK', [('Content-Type', 'application/json'),
+                                  ('Content-Length', str(len(body)))])
+        return [body]
+
+    def __call__(self, environ, start_response):
+
+        if self.health_path and environ.get('PATH_INFO') == self.health_path:
+            return self.health(environ, start_response)
+
+        path = environ.get('PATH_INFO', '')
+        script_name = environ.get('HTTP_X_SCRIPT_NAME', self.prefix)
+        if script_name and path.startswith(script_name):
+            path = path[len(script_name):]
+
+        index = route(path, len(self.workers))
+
+        length = environ.get('CONTENT_LENGTH')
+        body = environ['wsgi.input'].read(int(length)) if length else None
+
+        begin = time.time()
+        try:
+            worker, (con, rv) = self.dispatch(index, environ, body)
+        except (HTTPException, socket.error) as ex:
+            worker = self.workers[index]
+            logger.error("worker %i (pid %i): %s", worker.index, worker.pid, ex)
+            with self.lock:
+                worker.observe(time.time() - begin, True)
+            start_response('502 Bad Gateway', [('Content-Type', 'text/plain')])
+            return [b'Bad Gateway']
+
+        with self.lock:
+            worker.observe(time.time() - begin, rv.status >= 500)
+        start_response('%i %s' % (rv.status, rv.reason),
+                       [(k, v) for k, v in rv.getheaders() if k.lower() not in HOP_BY_HOP])
+        return self.relay(con, rv)
+
+    def relay(self, con, rv):
+        done = False
+        try:
+            while True:
+                chunk = rv.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+            done = True
+        finally:
+            if not done:  # the client went away, the rest is still on the wire
+                con.close()
+
+    def handle(self, signum, frame):
+        self.signals.append(signum)
+
+    def serve(self, host, port):
+        """Fork the workers and proxy requests on host:port until SIGINT or
+        SIGTERM."""
+
+        for i in range(len(self.workers)):
+            self.workers[i] = self.spawn(i)
+
+        self.server = make_server(host, port, self, threaded=True)
+        thread = threading.Thread(target=self.server.serve_forever, name="weave-master")
+        thread.daemon = True
+        thread.start()
+
+        # signals only interrupt the select() below through this pipe
+        r, w = os.pipe()
+        for fd in r, w:
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        signal.set_wakeup_fd(w)
+
+        for signum in (signal.SIGHUP, signal.SIGINT, signal.SIGTERM, signal.SIGCHLD):
+            signal.signal(signum, self.handle)
+
+        logger.info("master (pid %i) serving %i workers on http://%s:%i/",
+                    os.getpid(), len(self.workers), host, port)
+
+        try:
+            while True:
+                try:
+                    select.select([r], [], [], 1)
+                    while os.read(r, 64):
+                        pass
+                except (select.error, OSError):
+                    pass  # EINTR on Python 2, EAGAIN once drained
+                signals, self.signals = set(self.signals), []
+                if signal.SIGINT in signals or signal.SIGTERM in signals:
+                    break
+                if signal.SIGHUP in signals:
+                    self.reload()
+                self.reap()
+        finally:
+            self.server.shutdown()
+            self.stop()
+
+        logger.info("master (pid %i) stopped", os.getpid())
+        sys.exit(0)
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+import json
+import base64
+
+from weave.minimal.cache import LRUCache
+from weave.minimal.compat import string_types
+from weave.minimal.utils import BadRequest
+
+# SQL strings by (kind, table, fields, scope, shape)
+statements = LRUCache(1024)
+
+# parameter -> (condition, type), in the order they appear in WHERE
+FILTERS = [
+    ('ids', 'id IN (SELECT value FROM json_each(?))', None),
+    ('older', 'modified < ?', float),
+    ('newer', 'modified > ?', float),
+    ('index_above', 'sortindex > ?', int),
+    ('index_below', 'sortindex < ?', int),
+    ('parentid', 'parentid = ?', None),
+    ('predecessorid', 'predecessorid = ?', None),
+]
+
+# sort -> (column, direction), the id breaks ties
+SORTS = {
+    'index': ('sortindex', 'DESC'),
+    'oldest': ('modified', 'ASC'),
+    'newest': ('modified', 'DESC'),
+}
+
+
+def encode(sort, key, id):
+    """Opaque continuation token for the item after (key, id)."""
+    return base64.urlsafe_b64encode(json.dumps([sort, key, id]).encode('utf-8')).decode('ascii')
+
+
+def decode(token, sort):
+    try:
+        rv = json.loads(base64.urlsafe_b64decode(str(token)).decode('utf-8'))
+    except (ValueError, TypeError, UnicodeError):
+        raise BadRequest
+    if not isinstance(rv, list) or len(rv) != 3 or rv[0] != sort:
+        raise BadRequest
+    key, id = rv[1], rv[2]
+    if not isinstance(id, string_types) or isinstance(key, bool) or not (
+            key is None or isinstance(key, (int, float) + string_types)):
+        raise BadRequest
+    return key, id
+
+
+class Query(object):
+    """The filter, sort and limit arguments of a collection request.
+
+    Values are never part of the SQL, they are bound as parameters.  Requests
+    with the same arguments (but different values) share the same `shape`
+    and therefore the same SQL string, which lets SQLite reuse the prepared
+    statement from the connection's statement cache.
+
+    The `scope` columns restrict a table shared by several collections (or
+    users) to one of them, their values are bound first.
+
+    Sorted, limited requests page through the collection using the tokens
+    returned by :meth:`next`: a token is passed back as `offset` and seeks
+    to the item after the last one seen using the (modified, id) or
+    (sortindex, id) index instead of skipping rows.  Integer offsets still
+    work as before.
+
+    :param args: the request arguments
+    :raises BadRequest: on malformed numbers or tokens
+    """
+
+    def __init__(self, args):
+        self.filters = []
+        self.params = []
+        self.ids = None
+
+        for key, condition, type in FILTERS:
+            value = args.get(key, None)
+            if value is None:
+                continue
+            if key == 'ids':
+                self.ids = [x.strip() for x in value.split(',')]
+                value = json.dumps(self.ids)
+            elif type is not None:
+                try:
+                    value = type(value)
+                except ValueError:
+                    raise BadRequest
+            self.filters.append(key)
+            self.params.append(value)
+
+        self.sort = args.get('sort', None)
+        if self.sort not in SORTS:
+            self.sort = None
+
+        # like SQLite's LIMIT, zero or negative limits return everything
+        try:
+            self.limit = max(int(args.get('limit', None) or 0), 0) or None
+        except ValueError:
+            raise BadRequest
+
+        # offsets are ignored without a limit
+        self.offset, self.after = None, None
+        offset = args.get('offset', None)
+        if self.limit and offset:
+            try:
+                self.offset = int(offset) or None
+            except ValueError:
+                self.after = decode(offset, self.sort)
+            else:
+                if self.offset is not None and self.offset < 0:
+                    raise BadRequest
+
+    @property
+    def shape(self):
+        return (tuple(self.filters), self.sort, self.limit is not None,
+                self.offset is not None, self.seek)
+
+    @property
+    def bulk(self):
+        """Selects items by id only, so a DELETE does not need to look at any
+        other column, see :meth:`weave.minimal.backend.Store.delete`."""
+        return self.filters == ['ids'] and not self.limit
+
+    @property
+    def seek(self):
+        """None, "key" or "null" if continuing after an item without a
+        sortindex."""
+        if self.after is None:
+            return None
+        return 'null' if self.after[0] is None else 'key'
+
+    @property
+    def merge(self):
+        # Items without a sortindex come last, but (sortindex, id) < (?, ?)
+        # excludes them.  Merging both index ranges avoids a full index scan.
+        return self.sort == 'index' and self.seek == 'key'
+
+    def where(self, seek=True, scope=()):
+        conditions = ['%s = ?' % column for column in scope]
+        conditions.extend(condition for key, condition, type in FILTERS if key in self.filters)
+        conditions.append('(expiry IS NULL OR expiry > ?)')
+        if seek and self.after is not None:
+            column, direction = SORTS[self.sort]
+            op = '<' if direction == 'DESC' else '>'
+            if self.seek == 'null':
+                conditions.append('%s IS NULL AND id %s ?' % (column, op))
+            else:
+                conditions.append('(%s, id) %s (?, ?)' % (column, op))
+        return ' WHERE ' + ' AND '.join(conditions)
+
+    def order(self, column=None, id='id'):
+        if self.sort is None:
+            return ''
+        key, direction = SORTS[self.sort]
+        return ' ORDER BY %s %s, %s %s' % (column or key, direction, id, direction)
+
+    def bounds(self, more=False):
+        if not self.limit:
+            return ''
+        return ' LIMIT ?' + (' + 1' if more else '') + (' OFFSET ?' if self.offset else '')
+
+    def bind(self, now, scope=()):
+        params = list(scope) + self.params + [now]
+        if self.after is not None:
+            params.extend(self.after[1:] if self.seek == 'null' else self.after)
+        if self.merge:
+            params.extend(list(scope) + self.params + [now])
+        if self.limit:
+            params.append(self.limit)
+        if self.offset:
+            params.append(self.offset)
+        return params
+
+    def next(self, rows):
+        """Returns the number of items on this page and the offset of the next
+        page (or None) given the result of the "page" statement."""
+
+        if len(rows) <= self.limit:
+            return len(rows), None
+        if self.sort is None:
+            return self.limit, str((self.offset or 0) + self.limit)
+        id, key = rows[self.limit - 1]
+        return self.limit, encode(self.sort, key, id)
+
+    def compile(self, kind, table, fields=('id', ), scope=()):
+        key = kind, table, tuple(fields), tuple(scope), self.shape
+        return statements.load(key, lambda: getattr(self, kind)(table, fields, scope))
+
+    def select(self, table, fields, scope=(), more=False):
+        columns = ','.join(fields)
+        if not self.merge:
+            return 'SELECT %s FROM %s' % (columns, table) \
+                   + self.where(scope=scope) + self.order() + self.bounds(more)
+
+        return ('SELECT %s FROM (SELECT %s, sortindex AS _key, id AS _id FROM %s%s '
+                'UNION ALL SELECT %s, sortindex AS _key, id AS _id FROM %s%s '
+                'AND sortindex IS NULL%s%s)') % (
+                columns, columns, table, self.where(scope=scope), columns, table,
+                self.where(False, scope), self.order('_key', '_id'), self.bounds(more))
+
+    def page(self, table, fields, scope=()):
+        """The ids (and sort keys) of a limited request plus one item to look
+        ahead whether there is a next page."""
+        if self.sort is None:
+            return self.select(table, ['id'], scope, more=True)
+        return self.select(table, ['id', SORTS[self.sort][0]], scope, more=True)
+
+    def count(self, table, fields, scope=()):
+        return 'SELECT COUNT(*) FROM %s' % table + self.where(scope=scope)
+
+    def delete(self, table, fields, scope=()):
+        key = ', '.join(tuple(scope) + ('id', ))
+        return 'DELETE FROM %s WHERE (%s) IN (%s)' % (
+            table, key, self.select(table, list(scope) + ['id'], scope))
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+import os
+import json
+import logging
+import threading
+
+logger = logging.getLogger("weave-minimal")
+
+
+class Quota(object):
+    """Storage limits in KB: a `default` for every user, overridden per user
+    by a JSON file mapping uids to KB (null is unlimited).  The file is read
+    again when it changes, an invalid file keeps the previous limits.
+
+    :param default: KB per user, None is unlimited
+    :param path: the JSON file, optional
+    """
+
+    def __init__(self, default=None, path=None):
+        self.default = default
+        self.path = path
+        self.lock = threading.Lock()
+        self.mtime = None
+        self.overrides = {}
+
+    def reload(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            mtime = None
+
+        with self.lock:
+            if mtime == self.mtime:
+                return
+            self.mtime = mtime
+
+            if mtime is None:
+                self.overrides = {}
+                return
+
+            try:
+                with open(self.path) as fp:
+                    overrides = json.load(fp)
+                if not isinstance(overrides, dict):
+                    raise ValueError("not an object")
+            except (IOError, ValueError) as ex:
+                logger.error("unable to read quota from `%s`: %s", self.path, ex)
+            else:
+                self.overrides = overrides
+
+    def limit(self, uid):
+        """The quota of `uid` in KB or None if unlimited."""
+
+        if self.path is not None:
+            self.reload()
+
+        overrides = self.overrides
+        return overrides[uid] if uid in overrides else self.default
@@ -4,9 +4,10 @@
 import sys
 import math
 import time
-import json
 import sqlite3
 
+from hashlib import sha1
+
 from werkzeug.wrappers import Response
 from werkzeug.exceptions import PreconditionFailed
 
@@ -25,85 +26,426 @@ if sys.version_info < (2, 7):
     defaultround = round
     setattr(__builtin__, 'round', lambda x, i: Float(defaultround(x, 2), i))
 
-from weave.minimal.utils import login, wbo2dict, convert, BadRequest
-from weave.minimal.compat import iteritems
-from weave.minimal.constants import WEAVE_INVALID_WBO
+from weave.minimal.utils import login, stream, dumps, BadRequest
+from weave.minimal.query import Query
+from weave.minimal.compat import iteritems, string_types
+from weave.minimal.constants import WEAVE_INVALID_WBO, WEAVE_OVER_QUOTA
 
 FIELDS = ['id', 'modified', 'sortindex', 'payload', 'parentid', 'predecessorid', 'ttl']
 
+# number of rows fetched (and serialized) at once for collection responses
+CHUNK_SIZE = 512
+
+
+def iter_tables(db):
+    """iters all collection tables, regardless of the metadata table"""
+    res = db.execute("SELECT name FROM sqlite_master WHERE type='table' "
+                     "AND name != '_collections';").fetchall()
+    return [x[0] for x in res]
 
-def iter_collections(dbpath):
+
+def iter_collections(db):
     """iters all available collection_ids"""
-    with sqlite3.connect(dbpath) as db:
-        res = db.execute("SELECT name FROM sqlite_master WHERE type='table';").fetchall()
+    res = db.execute("SELECT name FROM _collections;").fetchall()
     return [x[0] for x in res]
 
 
-def expire(dbpath, cid):
+def get_metadata(app, store):
+    """Returns a dict of collection -> (modified, count, usage) from the
+    metadata table, cached in-process until the next write."""
+
+    def load():
+        with app.pool.connect(store.dbpath) as db:
+            return store.metadata(db)
+
+    return app.metadata.load(store.key, load)
+
+
+def changed(app, store, cid):
+    """Drop the cached metadata and items of `store` after a write to `cid`."""
+    app.metadata.invalidate(store.key)
+    app.records.invalidate((store.key, cid))
+
+
+def last_modified(metadata, cid=None):
+    """The last-modified timestamp of a collection (or of all collections)
+    from the metadata returned by :func:`get_metadata`, None if empty."""
+
+    if cid is not None:
+        return metadata.get(cid, (None, ))[0]
+    return max([v[0] for v in metadata.values() if v[0] is not None] or [None])
+
+
+def conditional(request, modified, *keys):
+    """Returns the X-Last-Modified and ETag headers of a response that only
+    changes with `modified` and `keys` (query, content type and so on) and
+    whether the client's copy is still current according to
+    X-If-Modified-Since or If-None-Match."""
+
+    etag = sha1(repr((modified, ) + keys).encode('utf-8')).hexdigest()[:16]
+    headers = {'X-Last-Modified': '%.2f' % (modified or 0), 'ETag': '"%s"' % etag}
+
+    since = request.headers.get('X-If-Modified-Since', None)
+    if since is not None:
+        try:
+            since = float(since)
+        except ValueError:
+            raise BadRequest
+        if modified is not None and modified <= since:
+            return headers, True
+
+    # compressed responses carry a weak ETag
+    return headers, request.if_none_match.contains_weak(etag)
+
+
+def expire(db, cid, now=None):
+    """Delete expired items, returns the number of deleted rows.  Requests
+    only filter expired items, see :class:`weave.minimal.expiry.Sweeper`."""
     try:
-        with sqlite3.connect(dbpath) as db:
-            db.execute("DELETE FROM %s WHERE (%s - modified) > ttl" % (cid, time.time()))
+        return db.execute("DELETE FROM %s WHERE expiry < ?" % cid,
+                          [now or time.time()]).rowcount
     except sqlite3.OperationalError:
-        pass
+        return 0
 
 
-def has_modified(since, dbpath, cid):
+def fetch(app, dbpath, sql, params=(), size=CHUNK_SIZE):
+    """Yields the result of `sql` in lists of `size` rows.  The connection is
+    checked out until the generator is exhausted or closed."""
+
+    with app.pool.connect(dbpath) as db:
+        cur = db.execute(sql, params)
+        while True:
+            rows = cur.fetchmany(size)
+            if not rows:
+                break
+            yield rows
+
+
+def has_modified(since, store, db, cid):
     """On any write transaction (PUT, POST, DELETE), if the collection to be acted
     on has been modified since the provided timestamp, the request will fail with
     an HTTP 412 Precondition Failed status."""
 
-    with sqlite3.connect(dbpath) as db:
+    modified = store.modified(db, cid)
+    return modified is not None and since < modified
 
-        try:
-            sql = 'SELECT MAX(modified) FROM %s' % cid
-            rv = db.execute(sql).fetchone()
-        except sqlite3.OperationalError:
-            return False
 
-        return rv and since < rv[0]
+def precondition(request, store, db, cid):
+    """Raise PreconditionFailed if `cid` has been modified since the request's
+    X-If-Unmodified-Since.  Called within the write, see :func:`write`."""
+
+    since = request.headers.get('X-If-Unmodified-Since', None)
+    if since and has_modified(float(since), store, db, cid):
+        raise PreconditionFailed
+
+
+def get_limit(app, uid):
+    """The quota of `uid` in KB or None if unlimited."""
+    quota = getattr(app, 'quota', None)
+    return quota.limit(uid) if quota is not None else None
+
+
+def check_quota(store, db, cid, limit, rows):
+    """Raise BadRequest if writing `rows` grows the payload beyond `limit` KB.
+    Only the difference to the items they replace is charged, rows without a
+    payload keep the previous one.  Called within the write, before any row
+    is written."""
+
+    if limit is None:
+        return
+
+    sizes = dict((obj['id'], obj['payload_size']) for obj in rows
+                 if obj['payload'] is not None)
+    if not sizes:
+        return
+
+    size = sum(sizes.values()) - store.sizes(db, cid, list(sizes))
+    if size > 0 and store.usage(db) + size > limit * 1024:
+        raise BadRequest(WEAVE_OVER_QUOTA)
+
+
+def write(app, store, job):
+    """Run `job(db)` in a write transaction and return its result.  The
+    transaction holds the write lock from the start, so checks made by the
+    job (preconditions, quota) still hold when it commits.  With
+    `--coalesce-window`, concurrent writes to the same database share a
+    transaction, see :class:`weave.minimal.writer.Writer`."""
+
+    writer = getattr(app, 'writer', None)
+    if writer is not None:
+        return writer.submit(store.dbpath, job)
+
+    with app.pool.connect(store.dbpath) as db:
+        db.execute('BEGIN IMMEDIATE')
+        return job(db)
+
+
+COLUMNS = ['id', 'modified', 'sortindex', 'payload', 'payload_size',
+           'parentid', 'predecessorid', 'ttl', 'expiry']
+
+# fields with a secondary index, see `create_indexes`
+INDEXES = ['modified', 'sortindex', 'parentid', 'predecessorid']
+
+# the sort keys are indexed together with the id for keyset pagination
+KEYS = {'modified': 'modified, id', 'sortindex': 'sortindex, id'}
+
+def fragment(value):
+    """SQL expression serializing a WBO to JSON, the SQL value of each field
+    is `value(field)`.  json_patch drops nulls."""
+    return "CAST(json_patch('{}', json_object(%s)) AS BLOB)" % ', '.join(
+        "'%s', %s" % (field, value(field)) for field in FIELDS)
+
+
+def upsert(table, scope=()):
+    """Insert a WBO or update the fields present in the new record, all other
+    fields keep their previous value.  The serialized WBO is kept in `wbo`.
+    Items are unique by the `scope` columns plus id."""
+
+    columns = list(scope) + COLUMNS
+    return ('INSERT INTO %s (%s, wbo) VALUES (%s, %s) ON CONFLICT(%s) DO UPDATE SET '
+            'modified=excluded.modified, '
+            'sortindex=COALESCE(excluded.sortindex, sortindex), '
+            'payload=COALESCE(excluded.payload, payload), '
+            'payload_size=CASE WHEN excluded.payload IS NULL '
+                'THEN payload_size ELSE excluded.payload_size END, '
+            'parentid=COALESCE(excluded.parentid, parentid), '
+            'predecessorid=COALESCE(excluded.predecessorid, predecessorid), '
+            'ttl=COALESCE(excluded.ttl, ttl), '
+            'expiry=excluded.modified + COALESCE(excluded.ttl, ttl), '
+            'wbo=%s') % (
+            table, ', '.join(columns), ', '.join(':' + x for x in columns),
+            fragment(lambda field: ':' + field), ', '.join(list(scope) + ['id']),
+            fragment(lambda field: {'id': 'id', 'modified': 'excluded.modified'}.get(
+                     field, 'COALESCE(excluded.%s, %s)' % (field, field))))
+
+
+# the statement of a collection table, UPSERT % cid
+UPSERT = upsert('%s')
+
+
+def create_collection(db, cid):
+
+    if db.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?",
+                  [cid]).fetchone():
+        return
+
+    sql = ('main.%s (id VARCHAR(64) PRIMARY KEY, modified FLOAT,'
+           'sortindex INTEGER, payload VARCHAR(256),'
+           'payload_size INTEGER, parentid VARCHAR(64),'
+           'predecessorid VARCHAR(64), ttl INTEGER, expiry FLOAT, wbo BLOB)') % cid
+    db.execute("CREATE table IF NOT EXISTS %s;" % sql)
+    create_indexes(db, cid, INDEXES)
+    create_indexes(db, cid, ['expiry'])
+    create_triggers(db, cid)
+    db.execute('INSERT OR IGNORE INTO _collections (name) VALUES (?)', [cid])
+
+
+def create_indexes(db, cid, fields):
+    """Indexes for the newer/older, sort, parentid and predecessorid filters
+    and a partial index on the expiry time of items with a TTL."""
+
+    for field in fields:
+        db.execute('CREATE INDEX IF NOT EXISTS idx_%s_%s ON %s (%s)%s' % (
+                   cid, field, cid, KEYS.get(field, field),
+                   ' WHERE expiry IS NOT NULL' if field == 'expiry' else ''))
+
+
+# SQL of the current time and of the modified timestamp of a collection after
+# deleting the row OLD: deletions bump it to the current time, unless the row
+# had expired -- it was not visible anymore, so the collection did not change.
+NOW = "((julianday('now') - 2440587.5) * 86400.0)"
+DELETED = ("CASE WHEN OLD.expiry IS NULL OR OLD.expiry > %s "
+           "THEN MAX(COALESCE(modified, 0), ROUND(%s, 2)) ELSE modified END" % (NOW, NOW))
+
+
+def create_triggers(db, cid):
+    """Keep the per-collection modified timestamp, item count and payload
+    usage in `_collections` up to date, see :data:`DELETED`."""
+
+    db.execute(
+        "CREATE TRIGGER IF NOT EXISTS trg_%s_insert AFTER INSERT ON %s BEGIN "
+        "UPDATE _collections SET count = count + 1, "
+        "usage = usage + COALESCE(NEW.payload_size, 0), "
+        "modified = MAX(COALESCE(modified, 0), NEW.modified) "
+        "WHERE name = '%s'; END" % (cid, cid, cid))
+    db.execute(
+        "CREATE TRIGGER IF NOT EXISTS trg_%s_update AFTER UPDATE ON %s BEGIN "
+        "UPDATE _collections SET usage = usage - COALESCE(OLD.payload_size, 0) "
+        "+ COALESCE(NEW.payload_size, 0), "
+        "modified = MAX(COALESCE(modified, 0), NEW.modified) "
+        "WHERE name = '%s'; END" % (cid, cid, cid))
+    db.execute(
+        "CREATE TRIGGER IF NOT EXISTS trg_%s_delete AFTER DELETE ON %s BEGIN "
+        "UPDATE _collections SET count = count - 1, "
+        "usage = usage - COALESCE(OLD.payload_size, 0), "
+        "modified = %s "
+        "WHERE name = '%s'; END" % (cid, cid, DELETED, cid))
+
+
+def migrate_indexes(db):
+    for cid in iter_tables(db):
+        create_indexes(db, cid, ['modified', 'sortindex', 'parentid', 'predecessorid'])
+
+
+def migrate_metadata(db):
+    db.execute('CREATE TABLE IF NOT EXISTS _collections (name VARCHAR(64) PRIMARY KEY, '
+               'modified FLOAT, count INTEGER NOT NULL DEFAULT 0, '
+               'usage INTEGER NOT NULL DEFAULT 0)')
+    for cid in iter_tables(db):
+        create_triggers(db, cid)
+        db.execute('INSERT OR REPLACE INTO _collections (name, modified, count, usage) '
+                   'SELECT ?, MAX(modified), COUNT(*), COALESCE(SUM(payload_size), 0) '
+                   'FROM %s' % cid, [cid])
+
+
+def migrate_expiry(db):
+    for cid in iter_tables(db):
+        db.execute('DROP INDEX IF EXISTS idx_%s_ttl' % cid)
+        db.execute('ALTER TABLE %s ADD COLUMN expiry FLOAT' % cid)
+        db.execute('UPDATE %s SET expiry = modified + ttl' % cid)
+        create_indexes(db, cid, ['expiry'])
+
+
+def migrate_keys(db):
+    for cid in iter_tables(db):
+        for field in KEYS:
+            db.execute('DROP INDEX IF EXISTS idx_%s_%s' % (cid, field))
+        create_indexes(db, cid, list(KEYS))
+
+
+def migrate_wbo(db):
+    for cid in iter_tables(db):
+        db.execute('ALTER TABLE %s ADD COLUMN wbo BLOB' % cid)
+        db.execute('UPDATE %s SET wbo = %s' % (cid, fragment(lambda field: field)))
+
+
+def migrate_triggers(db):
+    for cid in iter_tables(db):
+        db.execute('DROP TRIGGER IF EXISTS trg_%s_delete' % cid)
+        create_triggers(db, cid)
+
+
+# Schema migrations, MIGRATIONS[i] upgrades a database from `PRAGMA
+# user_version` i to i + 1.  New migrations must be appended.
+MIGRATIONS = [migrate_indexes, migrate_metadata, migrate_expiry, migrate_keys,
+              migrate_wbo, migrate_triggers]
+
+
+def migrate(db):
+    """Lazily upgrade the schema of a user database, called whenever a new
+    connection is opened."""
+
+    if db.execute('PRAGMA user_version').fetchone()[0] >= len(MIGRATIONS):
+        return
+
+    with db:
+        db.execute('BEGIN IMMEDIATE')
+        version = db.execute('PRAGMA user_version').fetchone()[0]
+        for i in range(version, len(MIGRATIONS)):
+            MIGRATIONS[i](db)
+        db.execute('PRAGMA user_version = %i' % len(MIGRATIONS))
+
+
+# Per-connection pragmas, selected by `weave-minimal --sqlite-profile`.  All
+# profiles use a write-ahead log, so readers do not block behind a writer.
+# "safe" syncs on every commit, "normal" only at WAL checkpoints (a power loss
+# may lose the last transactions, but never corrupts the database) and "fast"
+# leaves syncing to the operating system entirely.
+PROFILES = {
+    'safe': {'synchronous': 'FULL', 'cache_size': -2000,
+             'mmap_size': 0, 'temp_store': 'DEFAULT'},
+    'normal': {'synchronous': 'NORMAL', 'cache_size': -8000,
+               'mmap_size': 64 * 1024 * 1024, 'temp_store': 'MEMORY'},
+    'fast': {'synchronous': 'OFF', 'cache_size': -32000,
+             'mmap_size': 256 * 1024 * 1024, 'temp_store': 'MEMORY'},
+}
+
+
+def setup(db, profile='normal', schema=migrate):
+    """Prepare a newly opened connection: switch the database to WAL mode
+    (persistent, so usually a no-op), apply the pragma profile and migrate
+    the schema using `schema(db)`."""
+
+    if db.execute('PRAGMA journal_mode').fetchone()[0].lower() != 'wal':
+        db.execute('PRAGMA journal_mode = WAL')
 
+    for key, value in iteritems(PROFILES[profile]):
+        db.execute('PRAGMA %s = %s' % (key, value))
 
-def set_item(dbpath, uid, cid, data):
+    schema(db)
+
+
+def validate(data, modified):
+    """Returns a row for `data` or raises a ValueError on an invalid WBO."""
 
     obj = {'id': data['id']}
-    obj['modified'] = round(time.time(), 2)
+    obj['modified'] = modified
     obj['payload'] = data.get('payload', None)
+    if obj['payload'] is not None and not isinstance(obj['payload'], string_types):
+        raise ValueError
     obj['payload_size'] = len(obj['payload']) if obj['payload'] else 0
     obj['sortindex'] = data.get('sortindex', None)
     obj['parentid'] = data.get('parentid', None)
     obj['predecessorid'] = data.get('predecessorid', None)
     obj['ttl'] = data.get('ttl', None)
+    obj['expiry'] = None
 
     if obj['sortindex']:
         try:
             obj['sortindex'] = int(math.floor(float(obj['sortindex'])))
-        except ValueError:
-            return obj
-
-    with sqlite3.connect(dbpath) as db:
-        sql = ('main.%s (id VARCHAR(64) PRIMARY KEY, modified FLOAT,'
-               'sortindex INTEGER, payload VARCHAR(256),'
-               'payload_size INTEGER, parentid VARCHAR(64),'
-               'predecessorid VARCHAR(64), ttl INTEGER)') % cid
-        db.execute("CREATE table IF NOT EXISTS %s;" % sql)
+        except (TypeError, ValueError):
+            raise ValueError
 
-        into = []; values = []
-        for k,v in iteritems(obj):
-            into.append(k); values.append(v)
+    if any(isinstance(v, (dict, list)) for v in obj.values()):
+        raise ValueError
 
+    if obj['ttl'] is not None:
         try:
-            db.execute("INSERT INTO %s (%s) VALUES (%s);" % \
-                (cid, ', '.join(into), ','.join(['?' for x in values])), values)
-        except sqlite3.IntegrityError:
-            for k,v in iteritems(obj):
-                if v is None: continue
-                db.execute('UPDATE %s SET %s=? WHERE id=?;' % (cid, k), [v, obj['id']])
-        except sqlite3.InterfaceError:
+            obj['ttl'] = int(obj['ttl'])
+            obj['expiry'] = modified + obj['ttl']
+        except (TypeError, ValueError):
             raise ValueError
 
     return obj
 
 
+def set_items(store, db, cid, items, limit=None):
+    """Validates all `items` and writes the valid ones using a single statement.
+    Returns the timestamp and the succeeded and failed ids (or records).
+    Nothing is written if the valid items exceed the quota `limit`."""
+
+    modified = round(time.time(), 2)
+    success, failed, rows = [], [], []
+
+    for item in items:
+        if not isinstance(item, dict) or 'id' not in item:
+            failed.append(item)
+            continue
+
+        try:
+            obj = validate(item, modified)
+        except ValueError:
+            failed.append(item['id'])
+        else:
+            rows.append(obj)
+            success.append(obj['id'])
+
+    if rows:
+        check_quota(store, db, cid, limit, rows)
+        store.upsert(db, cid, rows)
+
+    return modified, success, failed
+
+
+def set_item(store, db, cid, data, limit=None):
+
+    obj = validate(data, round(time.time(), 2))
+    check_quota(store, db, cid, limit, [obj])
+    store.upsert(db, cid, [obj])
+
+    return obj
+
+
 @login(['GET', 'HEAD'])
 def get_collections_info(app, environ, request, version, uid):
     """Returns a hash of collections associated with the account,
@@ -112,19 +454,19 @@ def get_collections_info(app, environ, request, version, uid):
     if request.method == 'HEAD' or request.authorization.username != uid:
         return Response('Not Authorized', 401)
 
-    dbpath = app.dbpath(uid, request.authorization.password)
-    ids = iter_collections(dbpath); collections = {}
+    store = app.store(uid, request.authorization.password)
+    metadata = get_metadata(app, store)
+
+    headers, fresh = conditional(request, last_modified(metadata), request.path,
+                                 sorted(metadata.items()))
+    if fresh:
+        return Response(status=304, headers=headers)
 
-    with sqlite3.connect(dbpath) as db:
-        for id in ids:
-            x = db.execute('SELECT id, MAX(modified) FROM %s;' % id).fetchall()
-            for k,v in x:
-                if not k:
-                    continue # XXX: why None, None yields here?
-                collections[id] = round(v, 2)
+    collections = dict((k, round(v[0], 2)) for k, v in iteritems(metadata) if v[1] > 0)
 
-    return Response(json.dumps(collections), 200, content_type='application/json',
-                    headers={'X-Weave-Records': str(len(collections))})
+    headers['X-Weave-Records'] = str(len(collections))
+    return Response(dumps(collections), 200, content_type='application/json',
+                    headers=headers)
 
 
 @login(['GET', 'HEAD'])
@@ -135,16 +477,19 @@ def get_collection_counts(app, environ, request, version, uid):
     if request.method == 'HEAD' or request.authorization.username != uid:
         return Response('Not Authorized', 401)
 
-    dbpath = app.dbpath(uid, request.authorization.password)
-    ids = iter_collections(dbpath); collections = {}
+    store = app.store(uid, request.authorization.password)
+    metadata = get_metadata(app, store)
 
-    with sqlite3.connect(dbpath) as db:
-        for id in ids:
-            cur = db.execute('SELECT id FROM %s;' % id)
-            collections[id] = len(cur.fetchall())
+    headers, fresh = conditional(request, last_modified(metadata), request.path,
+                                 sorted(metadata.items()))
+    if fresh:
+        return Response(status=304, headers=headers)
 
-    return Response(json.dumps(collections), 200, content_type='application/json',
-                    headers={'X-Weave-Records': str(len(collections))})
+    collections = dict((k, v[1]) for k, v in iteritems(metadata))
+
+    headers['X-Weave-Records'] = str(len(collections))
+    return Response(dumps(collections), 200, content_type='application/json',
+                    headers=headers)
 
 
 @login(['GET', 'HEAD'])
@@ -155,16 +500,19 @@ def get_collection_usage(app, environ, request, version, uid):
     if request.method == 'HEAD' or request.authorization.username != uid:
         return Response('Not Authorized', 401)
 
-    dbpath = app.dbpath(uid, request.authorization.password)
-    with sqlite3.connect(dbpath) as db:
-        res = {}
-        for table in iter_collections(dbpath):
-            v = db.execute('SELECT SUM(payload_size) FROM %s' % table).fetchone()[0] or 0
-            res[table] = v/1024.0
+    store = app.store(uid, request.authorization.password)
+    metadata = get_metadata(app, store)
+
+    headers, fresh = conditional(request, last_modified(metadata), request.path,
+                                 sorted(metadata.items()))
+    if fresh:
+        return Response(status=304, headers=headers)
+
+    res = dict((k, v[2]/1024.0) for k, v in iteritems(metadata))
 
-    js = json.dumps(res)
-    return Response(js, 200, content_type='application/json',
-                    headers={'X-Weave-Records': str(len(js))})
+    js = dumps(res)
+    headers['X-Weave-Records'] = str(len(js))
+    return Response(js, 200, content_type='application/json', headers=headers)
 
 
 @login(['GET', 'HEAD'])
@@ -172,25 +520,38 @@ def get_quota(app, environ, request, version, uid):
     if request.method == 'HEAD' or request.authorization.username != uid:
         return Response('Not Authorized', 401)
 
-    dbpath = app.dbpath(uid, request.authorization.password)
-    with sqlite3.connect(dbpath) as db:
-        sum = 0
-        for table in iter_collections(dbpath):
-            sum += db.execute('SELECT SUM(payload_size) FROM %s' % table).fetchone()[0] or 0
+    store = app.store(uid, request.authorization.password)
+    metadata = get_metadata(app, store)
+
+    limit = get_limit(app, uid)
+
+    headers, fresh = conditional(request, last_modified(metadata), request.path,
+                                 sorted(metadata.items()), limit)
+    if fresh:
+        return Response(status=304, headers=headers)
+
+    sum = 0
+    for modified, count, usage in metadata.values():
+        sum += usage
     # sum = os.path.getsize(dbpath) # -- real usage
 
-    js = json.dumps([sum/1024.0, None])
-    return Response(js, 200, content_type='application/json',
-                    headers={'X-Weave-Records': str(len(js))})
+    js = dumps([sum/1024.0, limit])
+    headers['X-Weave-Records'] = str(len(js))
+    return Response(js, 200, content_type='application/json', headers=headers)
 
 
+@login(['DELETE'])
 def storage(app, environ, request, version, uid):
 
     if request.method == 'DELETE':
+        if request.authorization.username != uid:
+            return Response('Not Authorized', 401)
+
         if request.headers.get('X-Confirm-Delete', '0') == '1':
-            app.initialize(uid, request.authorization.password)
+            if not app.reset(uid, request.authorization.password):
+                return Response('Not Authorized', 401)
 
-            return Response(json.dumps(time.time()), 200)
+            return Response(dumps(time.time()), 200)
 
         return Response('Precondition Failed', 412)
 
@@ -202,117 +563,70 @@ def collection(app, environ, request, version, uid, cid):
     if request.method == 'HEAD' or request.authorization.username != uid:
         return Response('Not Authorized', 401)
 
-    dbpath = app.dbpath(uid, request.authorization.password)
-    expire(dbpath, cid)
-
-    ids    = request.args.get('ids', None)
-    offset = request.args.get('offset', None)
-    older  = request.args.get('older', None)
-    newer  = request.args.get('newer', None)
-    full   = request.args.get('full', False)
-    index_above = request.args.get('index_above', None)
-    index_below = request.args.get('index_below', None)
-    limit  = request.args.get('limit', None)
-    offset = request.args.get('offset', None)
-    sort   = request.args.get('sort', None)
-    parentid = request.args.get('parentid', None)
-    predecessorid = request.args.get('predecessorid', None)
+    store = app.store(uid, request.authorization.password)
 
-    try:
-        older and float(older)
-        newer and float(newer)
-        limit and int(limit)
-        offset and int(offset)
-        index_above and int(index_above)
-        index_below and int(index_below)
-    except ValueError:
-        raise BadRequest
-
-    if limit is not None:
-        limit = int(limit)
-
-    if offset is not None:
-        # we need both
-        if limit is None:
-            offset = None
-        else:
-            offset = int(offset)
-
-    if not full:
-        fields = ['id']
-    else:
-        fields = FIELDS
-
-    # filters used in WHERE clause
-    filters = {}
-    if ids is not None:
-        filters['id'] =  'IN', '(%s)' % ",".join("'" + x.strip() + "'" for x in ids.split(","))
-    if older is not None:
-        filters['modified'] = '<', float(older)
-    if newer is not None:
-        filters['modified'] = '>', float(newer)
-    if index_above is not None:
-        filters['sortindex'] = '>', int(index_above)
-    if index_below is not None:
-        filters['sortindex'] = '<', int(index_below)
-    if parentid is not None:
-        filters['parentid'] = '=', "'%s'" % parentid
-    if predecessorid is not None:
-        filters['predecessorid'] = '=', "'%s'" % predecessorid
-
-    filter_query, sort_query, limit_query = '', '', ''
-
-    # ORDER BY x ASC|DESC
-    if sort is not None:
-        if sort == 'index':
-            sort_query = ' ORDER BY sortindex DESC'
-        elif sort == 'oldest':
-            sort_query = ' ORDER BY modified ASC'
-        elif sort == 'newest':
-            sort_query = ' ORDER BY modified DESC'
-
-    # WHERE x<y AND ...
-    if filters:
-        filter_query = ' WHERE '
-        filter_query += ' AND '.join([k + ' ' + v[0] + ' ' + str(v[1])
-            for k, v in iteritems(filters)])
-
-    # LIMIT x [OFFSET y]
-    if limit:
-        limit_query += ' LIMIT %i' % limit
-        if offset:
-            limit_query += ' OFFSET %i' % offset
+    query = Query(request.args)
+    full = bool(request.args.get('full', False))
+    fields = ['wbo'] if full else ['id']
 
     if request.method == 'GET':
         # Returns a list of the WBO or ids contained in a collection.
 
-        with sqlite3.connect(dbpath) as db:
+        mime = request.accept_mimetypes.best
+        modified = last_modified(get_metadata(app, store), cid)
+        now = time.time()
+
+        # expired items are deleted in the background
+        select = store.compile(query, 'select', cid, fields)
+        params = store.bind(query, cid, now)
+
+        with app.pool.connect(store.dbpath) as db:
+            # items expiring change the response, but not `modified`
+            expires = store.expires(db, cid, now) if modified is not None else None
+            headers, fresh = conditional(request, modified, cid, request.query_string,
+                                         mime, expires)
+            if fresh:
+                return Response(status=304, headers=headers)
+
             try:
-                res = db.execute('SELECT %s FROM %s' % (','.join(fields), cid) \
-                      + filter_query + sort_query + limit_query).fetchall()
+                if query.limit:
+                    rows = db.execute(store.compile(query, 'page', cid), params).fetchall()
+                    records, offset = query.next(rows)
+                    if offset is not None:
+                        headers['X-Weave-Next-Offset'] = offset
+                else:
+                    records = db.execute(store.compile(query, 'count', cid),
+                                         params).fetchone()[0]
             except sqlite3.OperationalError:
-                res = []
+                records, select = 0, None
+        headers['X-Weave-Records'] = str(records)
 
-        res = [v[0] if len(fields) == 1 else wbo2dict(v) for v in res]
-        res, mime, records = convert(res, request.accept_mimetypes.best)
+        def chunks():
+            if select is None:
+                return
+            for rows in fetch(app, store.dbpath, select, params):
+                yield [bytes(v[0]) if full else v[0] for v in rows]
 
-        return Response(res, 200, content_type=mime,
-                        headers={'X-Weave-Records': str(records)})
+        res, mime = stream(chunks(), mime, raw=full)
 
-    # before we write, check if the data has not been modified since the request
-    since = request.headers.get('X-If-Unmodified-Since', None)
-    if since and has_modified(float(since), dbpath, cid):
-        raise PreconditionFailed
+        return Response(res, 200, content_type=mime, headers=headers)
 
     if request.method == 'DELETE':
-        try:
-            with sqlite3.connect(dbpath) as db:
-                select = 'SELECT id FROM %s' % cid + filter_query \
-                       + sort_query + limit_query
-                db.execute('DELETE FROM %s WHERE id IN (%s)' % (cid, select))
-        except sqlite3.OperationalError:
-            pass
-        return Response(json.dumps(time.time()), 200)
+
+        def delete(db):
+            # before we write, check if the data has not been modified since the request
+            precondition(request, store, db, cid)
+            try:
+                if query.bulk:
+                    return store.delete(db, cid, query.ids)
+                return db.execute(store.compile(query, 'delete', cid),
+                                  store.bind(query, cid, time.time())).rowcount
+            except sqlite3.OperationalError:
+                return 0
+
+        deleted = write(app, store, delete)
+        changed(app, store, cid)
+        return Response(dumps(time.time()), 200, headers={'X-Weave-Records': str(deleted)})
 
     elif request.method in ('PUT', 'POST'):
 
@@ -321,22 +635,19 @@ def collection(app, environ, request, version, uid, cid):
         if isinstance(data, dict):
             data = [data]
 
-        success, failed = [], []
-        for item in data:
-            if 'id' not in item:
-                failed.append(item)
-                continue
+        limit = get_limit(app, uid)
 
-            try:
-                o = set_item(dbpath, uid, cid, item)
-                success.append(o['id'])
-            except ValueError:
-                failed.append(item['id'])
+        def update(db):
+            precondition(request, store, db, cid)
+            return set_items(store, db, cid, data, limit)
 
-        js = json.dumps({'modified': round(time.time(), 2), 'success': success,
+        modified, success, failed = write(app, store, update)
+        changed(app, store, cid)
+
+        js = dumps({'modified': modified, 'success': success,
                          'failed': failed})
         return Response(js, 200, content_type='application/json',
-                        headers={'X-Weave-Timestamp': round(time.time(), 2)})
+                        headers={'X-Weave-Timestamp': modified})
 
 
 @login()
@@ -346,28 +657,35 @@ def item(app, environ, request, version, uid, cid, id):
     if request.method == 'HEAD' or request.authorization.username != uid:
         return Response('Not Authorized', 401)
 
-    dbpath = app.dbpath(uid, request.authorization.password)
-    expire(dbpath, cid)
+    store = app.store(uid, request.authorization.password)
 
     if request.method == 'GET':
-        try:
-            with sqlite3.connect(dbpath) as db:
-                res = db.execute('SELECT %s FROM %s WHERE id=?' % \
-                    (','.join(FIELDS), cid), [id]).fetchone()
-        except sqlite3.OperationalError:
-            # table can not exists, e.g. (not a nice way to do, though)
-            res = None
-
-        if res is None:
+
+        def load():
+            try:
+                with app.pool.connect(store.dbpath) as db:
+                    res = store.get(db, cid, id)
+            except sqlite3.OperationalError:
+                # table can not exists, e.g. (not a nice way to do, though)
+                return None
+            return res and (res[0], res[1], bytes(res[2]))
+
+        # cached until the next write to the collection, expired items are
+        # still cached but not served
+        res = app.records.load((store.key, cid, id), load)
+        if res is None or res[1] is not None and res[1] <= time.time():
             return Response(WEAVE_INVALID_WBO, 404)
 
-        js = json.dumps(wbo2dict(res))
-        return Response(js, 200, content_type='application/json',
-                        headers={'X-Weave-Records': str(len(res))})
+        # the item can not have changed if its collection has not
+        headers, fresh = conditional(request, last_modified(get_metadata(app, store), cid),
+                                     cid, id)
+        if fresh:
+            return Response(status=304, headers=headers)
 
-    since = request.headers.get('X-If-Unmodified-Since', None)
-    if since and has_modified(float(since), dbpath, cid):
-        return Response('Precondition Failed', 412)
+        headers['X-Last-Modified'] = '%.2f' % res[0]
+        headers['X-Weave-Records'] = str(len(FIELDS))
+        return Response(res[2], 200, content_type='application/json',
+                        headers=headers)
 
     if  request.method == 'PUT':
 
@@ -376,17 +694,34 @@ def item(app, environ, request, version, uid, cid, id):
         if id not in data:
             data['id'] = id
 
+        limit = get_limit(app, uid)
+
+        def update(db):
+            precondition(request, store, db, cid)
+            return set_item(store, db, cid, data, limit)
+
         try:
-            obj = set_item(dbpath, uid, cid, data)
+            obj = write(app, store, update)
         except ValueError:
             return Response(WEAVE_INVALID_WBO, 400)
+        except PreconditionFailed:
+            return Response('Precondition Failed', 412)
+        changed(app, store, cid)
 
-        return Response(json.dumps(obj['modified']), 200,
+        return Response(dumps(obj['modified']), 200,
             content_type='application/json',
             headers={'X-Weave-Timestamp': round(obj['modified'], 2)})
 
     elif request.method == 'DELETE':
-        with sqlite3.connect(dbpath) as db:
-            db.execute('DELETE FROM %s WHERE id=?' % cid, [id])
-        return Response(json.dumps(time.time()), 200,
+
+        def delete(db):
+            precondition(request, store, db, cid)
+            store.delete(db, cid, [id])
+
+        try:
+            write(app, store, delete)
+        except PreconditionFailed:
+            return Response('Precondition Failed', 412)
+        changed(app, store, cid)
+        return Response(dumps(time.time()), 200,
             content_type='application/json')
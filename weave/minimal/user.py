@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 # -*- encoding: utf-8 -*-
 
-import os
 import sqlite3
 
 from werkzeug.wrappers import Response
@@ -9,7 +8,7 @@ from werkzeug.wrappers import Response
 from weave.minimal.utils import login, BadRequest
 from weave.minimal.constants import (
     WEAVE_INVALID_WRITE, WEAVE_MISSING_PASSWORD,
-    WEAVE_WEAK_PASSWORD, WEAVE_INVALID_USER)
+    WEAVE_WEAK_PASSWORD)
 
 
 @login(['DELETE', 'POST'])
@@ -20,7 +19,7 @@ def index(app, environ, request, version, uid):
         return Response('', 200)
 
     elif request.method in ['GET']:
-        if not [p for p in os.listdir(app.data_dir) if p.split('.', 1)[0] == uid]:
+        if not app.exists(uid):
             code = '0' if app.registration else '1'
         else:
             code = '1'
@@ -28,7 +27,7 @@ def index(app, environ, request, version, uid):
 
     # Requests that an account be created for uid
     elif request.method == 'PUT':
-        if app.registration and not [p for p in os.listdir(app.data_dir) if p.startswith(uid)]:
+        if app.registration and not app.exists(uid):
 
             try:
                 passwd = request.get_json()['password']
@@ -36,10 +35,8 @@ def index(app, environ, request, version, uid):
                 raise BadRequest(WEAVE_MISSING_PASSWORD)
 
             try:
-                con = sqlite3.connect(app.dbpath(uid, passwd))
-                con.commit()
-                con.close()
-            except IOError:
+                app.initialize(uid, passwd)
+            except (IOError, sqlite3.Error):
                 raise BadRequest(WEAVE_INVALID_WRITE)
             return Response(uid, 200)
 
@@ -52,10 +49,7 @@ def index(app, environ, request, version, uid):
         if request.authorization.username != uid:
             return Response('Not Authorized', 401)
 
-        try:
-            os.remove(app.dbpath(uid, request.authorization.password))
-        except OSError:
-            pass
+        app.remove(uid, request.authorization.password)
         return Response('0', 200)
 
 
@@ -63,18 +57,16 @@ def index(app, environ, request, version, uid):
 def change_password(app, environ, request, version, uid):
     """POST https://server/pathname/version/username/password"""
 
-    if not [p for p in os.listdir(app.data_dir) if p.split('.', 1)[0] == uid]:
-        return Response(WEAVE_INVALID_USER, 404)
+    if request.authorization.username != uid:
+        return Response('Not Authorized', 401)
 
     if len(request.get_data(as_text=True)) == 0:
         return Response(WEAVE_MISSING_PASSWORD, 400)
     elif len(request.get_data(as_text=True)) < 4:
         return Response(WEAVE_WEAK_PASSWORD, 400)
 
-    old_dbpath = app.dbpath(uid, request.authorization.password)
-    new_dbpath = app.dbpath(uid, request.get_data(as_text=True))
     try:
-        os.rename(old_dbpath, new_dbpath)
+        app.rename(uid, request.authorization.password, request.get_data(as_text=True))
     except OSError:
         return Response(WEAVE_INVALID_WRITE, 503)
 
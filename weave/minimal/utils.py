@@ -5,20 +5,80 @@ import pkg_resources
 werkzeug = pkg_resources.get_distribution("werkzeug")
 
 import re
+import zlib
 import json
 import base64
 import struct
+import itertools
 
-from os.path import isfile
 from hashlib import sha1
 
 from werkzeug.wrappers import Request as _Request, Response
 from werkzeug.exceptions import BadRequest as _BadRequest
 
-from weave.minimal.compat import iterkeys
 from weave.minimal.constants import WEAVE_MALFORMED_JSON, WEAVE_INVALID_WBO
 
 
+class Serializer(object):
+    """A JSON backend, `dumps` returns bytes."""
+
+    def __init__(self, name, dumps, loads):
+        self.name = name
+        self.dumps = dumps
+        self.loads = loads
+
+
+def serializers():
+    """All installed JSON backends, fastest first."""
+
+    rv = []
+    try:
+        import orjson
+    except ImportError:
+        pass
+    else:
+        rv.append(Serializer('orjson', orjson.dumps, orjson.loads))
+
+    try:
+        import ujson
+    except ImportError:
+        pass
+    else:
+        rv.append(Serializer('ujson', lambda obj: ujson.dumps(
+            obj, ensure_ascii=False, escape_forward_slashes=False).encode('utf-8'),
+            ujson.loads))
+
+    try:
+        import rapidjson
+    except ImportError:
+        pass
+    else:
+        rv.append(Serializer('rapidjson', lambda obj: rapidjson.dumps(
+            obj, ensure_ascii=False).encode('utf-8'), rapidjson.loads))
+
+    rv.append(Serializer('json', lambda obj: json.dumps(obj).encode('utf-8'), json.loads))
+    return rv
+
+serializer = serializers()[0]
+
+
+def dumps(obj):
+    """Serialize `obj` to JSON encoded as UTF-8 bytes."""
+    try:
+        return serializer.dumps(obj)
+    except (TypeError, ValueError, OverflowError):
+        # integers beyond 64 bit, lone surrogates and the like
+        return json.dumps(obj).encode('utf-8')
+
+
+def loads(data):
+    """Deserialize JSON from bytes or text, raises ValueError if malformed."""
+    try:
+        return serializer.loads(data)
+    except ValueError:
+        return json.loads(data)
+
+
 class BadRequest(_BadRequest):
     """Remove fancy HTML from exceptions."""
 
@@ -39,7 +99,7 @@ class Request(_Request):
 
     def get_json(self):
         try:
-            data = json.loads(self.get_data(as_text=True))
+            data = loads(self.get_data())
         except ValueError:
             raise BadRequest(WEAVE_MALFORMED_JSON)
         else:
@@ -48,6 +108,28 @@ class Request(_Request):
             return data
 
 
+def partition(path):
+    """The user of a request path (/user/1.0/<uid>, /1.1/<uid>/...) or None."""
+    match = re.match(r'^/(?:user/)?[^/]+/([^/]+)', path)
+    return match.group(1) if match else None
+
+
+def shard(uid, n):
+    """The worker (of `n`) serving `uid`.  Stable across restarts (unlike
+    :func:`hash`)."""
+    return (zlib.crc32(uid.encode('utf-8')) & 0xffffffff) % n
+
+
+def chunked(iterable, size):
+    """Yields lists of `size` items of `iterable`, the last one may be shorter."""
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
 def encode(uid):
     if re.search('[^A-Z0-9._-]', uid, re.I):
         return base64.b32encode(sha1(uid).digest()).lower()
@@ -75,45 +157,47 @@ class login:
             else:
                 user = req.authorization.username
                 passwd = req.authorization.password
-                if not isfile(app.dbpath(user, passwd)):
+                if app.authenticate(user, passwd) is None:
                     return Response('Unauthorized', 401)  # kinda stupid
                 return f(app, env, req, *args, **kwargs)
         return dec
 
 
-def wbo2dict(query):
-    """converts sqlite table to WBO (dict [json-parsable])"""
-
-    res = {'id': query[0], 'modified': round(query[1], 2),
-           'sortindex': query[2], 'payload': query[3],
-           'parentid': query[4], 'predecessorid': query[5], 'ttl': query[6]}
-
-    for key in list(iterkeys(res)):
-        if res[key] is None:
-            res.pop(key)
+def stream(chunks, mime, raw=False):
+    """Serializes an iterable of record lists lazily as a JSON list,
+    application/newlines or application/whoisi (by `mime`) and returns a
+    generator yielding one encoded chunk per list and the content type.
+    With `raw`, the records are already serialized."""
 
-    return res
+    encode = bytes if raw else dumps
 
-
-def convert(value, mime):
-    """post processor producing lists in application/newlines format."""
-
-    if mime and mime.endswith(('/newlines', '/whoisi')):
-        try:
-            value = value["items"]
-        except (KeyError, TypeError):
-            pass
-
-        if mime.endswith('/whoisi'):
+    if mime and mime.endswith('/whoisi'):
+        def dump(records, first):
             res = []
-            for record in value:
-                js = json.dumps(record)
-                res.append(struct.pack('!I', len(js)) + js.encode('utf-8'))
-            rv = b''.join(res)
-        else:
-            rv = '\n'.join(json.dumps(item).replace('\n', '\000a') for item in value)
+            for record in records:
+                js = encode(record)
+                res.append(struct.pack('!I', len(js)) + js)
+            return b''.join(res)
+    elif mime and mime.endswith('/newlines'):
+        def dump(records, first):
+            rv = b'\n'.join(encode(item) for item in records)
+            return rv if first else b'\n' + rv
     else:
+        mime = 'application/json'
+
+        def dump(records, first):
+            rv = b', '.join(encode(item) for item in records)
+            return (b'[' if first else b', ') + rv
+
+    def generate():
+        first = True
+        for records in chunks:
+            if not records:
+                continue
+            yield dump(records, first)
+            first = False
 
-        rv, mime = json.dumps(value), 'application/json'
+        if mime == 'application/json':
+            yield b'[]' if first else b']'
 
-    return rv, mime, len(value)
+    return generate(), mime
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+import threading
+
+
+class Batch(object):
+
+    def __init__(self):
+        self.jobs = []  # [job, result, exception]
+        self.full = threading.Event()
+        self.done = threading.Event()
+
+
+class Writer(object):
+    """Coalesces concurrent writes to the same database into one transaction
+    (group commit), so a burst of small writes costs a single commit.
+
+    The first write to a database waits up to `window` seconds for others
+    to arrive (or until there are `max_batch` writes) and then runs all of
+    them in order, each in its own savepoint: a job that raises is rolled
+    back and its exception is re-raised in its request, the other jobs are
+    committed.  Jobs see the writes of the jobs before them, so they should
+    check their preconditions (and take their timestamp) when they run.
+
+    :param pool: the :class:`weave.minimal.pool.Pool`
+    :param window: seconds to wait for more writes
+    :param max_batch: maximum number of writes per transaction
+    """
+
+    def __init__(self, pool, window=0.005, max_batch=64):
+        self.pool = pool
+        self.window = window
+        self.max_batch = max_batch
+        self.lock = threading.Lock()
+
+        self.pending = {}  # dbpath -> Batch accepting writes
+
+        self.batches = 0
+        self.jobs = 0
+        self.failed = 0
+
+    def stats(self):
+        with self.lock:
+            return {'batches': self.batches, 'jobs': self.jobs, 'failed': self.failed}
+
+    def submit(self, dbpath, job):
+        """Run `job(db)` in the next transaction of `dbpath` and return its
+        result once committed."""
+
+        entry = [job, None, None]
+
+        with self.lock:
+            batch = self.pending.get(dbpath)
+            leader = batch is None
+            if leader:
+                batch = self.pending[dbpath] = Batch()
+            batch.jobs.append(entry)
+            if len(batch.jobs) >= self.max_batch:
+                del self.pending[dbpath]
+                batch.full.set()
+
+        if leader:
+            batch.full.wait(self.window)
+            with self.lock:
+                if self.pending.get(dbpath) is batch:
+                    del self.pending[dbpath]
+            self.commit(dbpath, batch)
+        else:
+            batch.done.wait()
+
+        if entry[2] is not None:
+            raise entry[2]
+        return entry[1]
+
+    def commit(self, dbpath, batch):
+        try:
+            with self.pool.connect(dbpath) as db:
+                db.execute('BEGIN IMMEDIATE')
+                for entry in batch.jobs:
+                    db.execute('SAVEPOINT job')
+                    try:
+                        entry[1] = entry[0](db)
+                    except Exception as ex:
+                        db.execute('ROLLBACK TO job')
+                        entry[2] = ex
+                    db.execute('RELEASE job')
+        except Exception as ex:
+            # the transaction is gone, so is every write
+            for entry in batch.jobs:
+                entry[1], entry[2] = None, entry[2] or ex
+        finally:
+            with self.lock:
+                self.batches += 1
+                self.jobs += len(batch.jobs)
+                self.failed += sum(1 for entry in batch.jobs if entry[2] is not None)
+            batch.done.set()